@@ -3,54 +3,2831 @@ import json
 import random
 import time
 import requests
+import requests.adapters
+import numpy as np
 import re
 import subprocess
 import logging
+import asyncio
+import sqlite3
+import threading
+import heapq
+import hashlib
+import io
+import math
+import string
+import itertools
+import bisect
+import contextlib
+import functools
+import sys
+import traceback
+import urllib.parse
+import pickle
+import signal
+import multiprocessing
+from collections import Counter, namedtuple, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta
 from logging.handlers import RotatingFileHandler
+from types import MappingProxyType
+from PIL import Image, ImageOps
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
+from telegram.error import RetryAfter
 from telegram.ext import (
     Application, 
     CommandHandler, 
     MessageHandler, 
     ContextTypes, 
     ConversationHandler,
+    BaseUpdateProcessor,
+    BasePersistence,
+    PersistenceInput,
+    TypeHandler,
     filters
 )
 
 # Set up logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        RotatingFileHandler('telegram_bot.log', maxBytes=10485760, backupCount=5),
-        logging.StreamHandler()
-    ]
-)
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+def log_file(path):
+    """Rotating log file handler; only one process may write to each file"""
+    handler = RotatingFileHandler(path, maxBytes=10485760, backupCount=5)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    return handler
+
+# Shard and pool workers re-import this module; they log to stderr, and each shard adds its own file
+logging.basicConfig(level=logging.INFO, format=LOG_FORMAT, handlers=[logging.StreamHandler()])
+if multiprocessing.parent_process() is None:
+    logging.getLogger().addHandler(log_file('telegram_bot.log'))
 logger = logging.getLogger('TelegramSocialBot')
 
-# Conversation states
-NICHE_SELECTION, MAIN_MENU, UPLOAD_CONTENT, YOUTUBE_PROCESSING = range(4)
+# Serving settings
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org/bot')
+TELEGRAM_FILE_URL = os.environ.get('TELEGRAM_FILE_URL', 'https://api.telegram.org/file/bot')
+CONCURRENT_UPDATES = int(os.environ.get('CONCURRENT_UPDATES', '64'))
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+
+# User store settings
+USER_STORE_PATH = os.environ.get('USER_STORE_PATH', 'user_data.db')
+USER_STORE_FLUSH_INTERVAL = float(os.environ.get('USER_STORE_FLUSH_INTERVAL', '2.0'))
+USER_STORE_BATCH_SIZE = int(os.environ.get('USER_STORE_BATCH_SIZE', '100'))
+
+# Video job settings
+VIDEO_WORKERS = int(os.environ.get('VIDEO_WORKERS', '2'))
+MAX_PENDING_VIDEO_JOBS = int(os.environ.get('MAX_PENDING_VIDEO_JOBS', '50'))
+MAX_VIDEO_JOBS_PER_USER = int(os.environ.get('MAX_VIDEO_JOBS_PER_USER', '2'))
+REELS_DIR = os.environ.get('REELS_DIR', 'reels')
+CLIP_MIN_SECONDS = 15
+CLIP_MAX_SECONDS = 45
+
+# YouTube metadata cache settings
+YOUTUBE_CACHE_SIZE = int(os.environ.get('YOUTUBE_CACHE_SIZE', '10000'))
+YOUTUBE_CACHE_TTL = int(os.environ.get('YOUTUBE_CACHE_TTL', str(6 * 3600)))
+YOUTUBE_MAX_DURATION = int(os.environ.get('YOUTUBE_MAX_DURATION', str(3 * 3600)))
+
+# Transcode settings
+TRANSCODE_DIR = os.environ.get('TRANSCODE_DIR', 'transcodes')
+FFMPEG_MAX_PROCESSES = int(os.environ.get('FFMPEG_MAX_PROCESSES', '0'))  # 0 derives it from CPUs and memory
+FFMPEG_MEMORY_PER_PROCESS = 512 * 1024 ** 2
+REEL_PRESETS = {
+    'reel': {
+        'filters': 'scale=1080:1920:force_original_aspect_ratio=increase,crop=1080:1920',
+        'codec': ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23', '-c:a', 'aac', '-movflags', '+faststart']
+    }
+}
+
+# Upload scheduler settings
+UPLOAD_QUEUE_PATH = os.environ.get('UPLOAD_QUEUE_PATH', 'upload_queue.db')
+DAILY_POST_LIMIT = int(os.environ.get('DAILY_POST_LIMIT', '10'))
+MAX_QUEUED_PER_ACCOUNT = int(os.environ.get('MAX_QUEUED_PER_ACCOUNT', '50'))
+POST_INTERVAL_MINUTES = int(os.environ.get('POST_INTERVAL_MINUTES', '60'))
+DEFAULT_POST_HOUR = 19
+
+# Media cache settings
+MEDIA_CACHE_DIR = os.environ.get('MEDIA_CACHE_DIR', 'downloads')
+MEDIA_CACHE_MAX_BYTES = int(os.environ.get('MEDIA_CACHE_MAX_BYTES', str(10 * 1024 ** 3)))
+PREPROCESS_WORKERS = int(os.environ.get('PREPROCESS_WORKERS', str(os.cpu_count() or 1)))
+MAX_PENDING_UPLOAD_JOBS = int(os.environ.get('MAX_PENDING_UPLOAD_JOBS', '200'))
+MAX_UPLOAD_JOBS_PER_USER = int(os.environ.get('MAX_UPLOAD_JOBS_PER_USER', '5'))
+INSTAGRAM_ASPECT_RATIOS = (1.0, 4 / 5, 9 / 16)
+MEDIA_OUTPUT_WIDTH = 1080
+THUMBNAIL_SIZE = 320
+MAX_CROP_LOSS = 0.2
+ALBUM_COLLECT_SECONDS = float(os.environ.get('ALBUM_COLLECT_SECONDS', '1.0'))
+ALBUM_DOWNLOAD_CONCURRENCY = int(os.environ.get('ALBUM_DOWNLOAD_CONCURRENCY', '4'))
+MAX_CAROUSEL_ITEMS = 10
+
+# Content strategy settings
+STRATEGIES_PATH = os.environ.get(
+    'STRATEGIES_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'niche_strategies.json')
+)
+STRATEGY_HOT_RELOAD = os.environ.get('STRATEGY_HOT_RELOAD', '0') == '1'
+
+# Hashtag ranking settings
+HASHTAG_INDEX_PATH = os.environ.get('HASHTAG_INDEX_PATH', 'hashtag_index.npz')
+HASHTAGS_PER_POST = 10
+
+# Duplicate detection settings
+DUPLICATE_INDEX_PATH = os.environ.get('DUPLICATE_INDEX_PATH', 'duplicate_index.npz')
+DUPLICATE_MAX_DISTANCE = int(os.environ.get('DUPLICATE_MAX_DISTANCE', '6'))  # differing bits out of 64
+DUPLICATE_WINDOW_DAYS = int(os.environ.get('DUPLICATE_WINDOW_DAYS', '30'))
+DUPLICATE_COMPACT_EVERY = 50000  # logged adds before the snapshot is rewritten
+VIDEO_KEYFRAMES = 8
+
+# Instagram publishing settings
+INSTAGRAM_GRAPH_URL = os.environ.get('INSTAGRAM_GRAPH_URL', 'https://graph.facebook.com/v21.0')
+INSTAGRAM_ACCOUNTS_PATH = os.environ.get('INSTAGRAM_ACCOUNTS_PATH', 'instagram_accounts.json')
+MEDIA_PUBLIC_URL = os.environ.get('MEDIA_PUBLIC_URL')  # public URL of MEDIA_CACHE_DIR, for photos
+PUBLISH_CONCURRENCY = int(os.environ.get('PUBLISH_CONCURRENCY', '8'))
+UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', str(8 * 1024 ** 2)))
+PUBLISH_MAX_RETRIES = int(os.environ.get('PUBLISH_MAX_RETRIES', '5'))
+PUBLISH_SESSIONS = 256
+
+# Analytics settings
+ANALYTICS_DIR = os.environ.get('ANALYTICS_DIR', 'analytics')
+INSIGHTS_DELAY_HOURS = float(os.environ.get('INSIGHTS_DELAY_HOURS', '24'))  # wait for metrics to settle
+INSIGHTS_POLL_SECONDS = 900
+INSIGHTS_GIVE_UP_DAYS = 7
+
+# Outbound message settings
+GLOBAL_MESSAGES_PER_SECOND = float(os.environ.get('GLOBAL_MESSAGES_PER_SECOND', '30'))
+CHAT_MESSAGES_PER_SECOND = float(os.environ.get('CHAT_MESSAGES_PER_SECOND', '1'))
+CHAT_MESSAGE_BURST = int(os.environ.get('CHAT_MESSAGE_BURST', '3'))
+MERGE_REPLIES = os.environ.get('MERGE_REPLIES', '1') == '1'
+MAX_MESSAGE_LENGTH = 4096
+PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND = range(2)
+
+# Metrics settings
+METRICS_LISTEN = os.environ.get('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '0'))  # 0 disables the metrics endpoint
+LOOP_LAG_INTERVAL = float(os.environ.get('LOOP_LAG_INTERVAL', '0.05'))
+LOOP_BLOCK_THRESHOLD = float(os.environ.get('LOOP_BLOCK_THRESHOLD', '0.25'))
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROFILE_MAX_SECONDS = 60
+
+# Persistence and sharding settings
+PERSISTENCE_PATH = os.environ.get('PERSISTENCE_PATH', 'conversations.db')
+PERSISTENCE_FLUSH_INTERVAL = float(os.environ.get('PERSISTENCE_FLUSH_INTERVAL', '1.0'))
+PERSISTENCE_BATCH_SIZE = int(os.environ.get('PERSISTENCE_BATCH_SIZE', '200'))
+SHARDS = int(os.environ.get('SHARDS', '1'))  # worker processes; each owns a hash range of user IDs
+
+# Conversation states
+NICHE_SELECTION, MAIN_MENU, UPLOAD_CONTENT, YOUTUBE_PROCESSING = range(4)
+
+# Niche options with emojis
+NICHES = {
+    'fitness': '💪 Fitness & Health',
+    'tech': '📱 Technology & Gadgets',
+    'business': '💼 Business & Entrepreneurship',
+    'travel': '✈️ Travel & Adventure',
+    'food': '🍔 Food & Cooking',
+    'fashion': '👗 Fashion & Beauty',
+    'motivation': '🔥 Motivation & Self-Improvement',
+    'education': '🎓 Education & Learning',
+    'entertainment': '🎬 Entertainment & Movies',
+    'gaming': '🎮 Gaming & Esports'
+}
+
+def shard_of(user_id, count):
+    """Map a user ID to one of count contiguous ranges of its 64-bit Fibonacci hash"""
+    return ((int(user_id) * 0x9E3779B97F4A7C15) % 2 ** 64) * count >> 64
+
+def per_shard_path(path, shard):
+    """Give each shard its own copy of single-writer state, e.g. analytics -> analytics.shard1"""
+    if shard is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{shard[0]}{ext}"
+
+class UserStore:
+    """Base class for user data storage backends"""
+    
+    def load(self):
+        """Return a dict of all stored users keyed by user ID"""
+        raise NotImplementedError
+    
+    def update(self, user_id, record):
+        """Queue a write of a single user's record"""
+        raise NotImplementedError
+    
+    def close(self):
+        """Flush pending writes and release resources"""
+
+class SQLiteWriteBehind:
+    """SQLite file in WAL mode whose writes are queued by key and applied in batches by a background thread"""
+    
+    def __init__(self, path, flush_interval, batch_size, thread_name):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.pending = {}
+        self.closed = False
+        self.condition = threading.Condition()
+        
+        conn = self._connect()
+        try:
+            self._setup(conn)
+        finally:
+            conn.close()
+        
+        self.writer = threading.Thread(target=self._writer_loop, name=thread_name, daemon=True)
+        self.writer.start()
+    
+    def _connect(self):
+        """Open a connection with WAL journaling; shard workers share the file"""
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+    
+    def _setup(self, conn):
+        """Create the tables"""
+        raise NotImplementedError
+    
+    def _write(self, conn, batch):
+        """Apply a batch of queued values, keyed as they were queued, in one transaction"""
+        raise NotImplementedError
+    
+    def _queue(self, key, value):
+        """Queue a write; the latest value queued for a key wins"""
+        with self.condition:
+            self.pending[key] = value
+            if len(self.pending) >= self.batch_size:
+                self.condition.notify()
+    
+    def _writer_loop(self):
+        """Flush pending writes every interval or once a batch fills up"""
+        conn = self._connect()
+        try:
+            while True:
+                with self.condition:
+                    self.condition.wait_for(
+                        lambda: self.closed or len(self.pending) >= self.batch_size,
+                        timeout=self.flush_interval
+                    )
+                    batch, self.pending = self.pending, {}
+                    closed = self.closed
+                
+                if batch:
+                    self._write(conn, batch)
+                if closed:
+                    break
+        finally:
+            conn.close()
+    
+    def _stop(self):
+        """Stop the writer thread after it drains pending writes"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.writer.join()
+
+class SQLiteUserStore(SQLiteWriteBehind, UserStore):
+    """User store backed by SQLite in WAL mode with batched write-behind"""
+    
+    def __init__(self, path=USER_STORE_PATH, flush_interval=USER_STORE_FLUSH_INTERVAL,
+                 batch_size=USER_STORE_BATCH_SIZE, legacy_path='user_data.json', shard=None):
+        self.shard = shard
+        self.legacy_path = legacy_path
+        super().__init__(path, flush_interval, batch_size, 'UserStoreWriter')
+    
+    def _setup(self, conn):
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY, data TEXT NOT NULL)')
+        self._migrate_legacy(conn)
+    
+    def _migrate_legacy(self, conn):
+        """Import the old user_data.json file into an empty store"""
+        if not self.legacy_path or not os.path.exists(self.legacy_path):
+            return
+        if conn.execute('SELECT 1 FROM users LIMIT 1').fetchone():
+            return
+        
+        with open(self.legacy_path, 'r') as f:
+            legacy = json.load(f)
+        
+        with conn:
+            conn.executemany(
+                'INSERT OR IGNORE INTO users (user_id, data) VALUES (?, ?)',
+                [(user_id, json.dumps(record)) for user_id, record in legacy.items()]
+            )
+        logger.info(f"Migrated {len(legacy)} users from {self.legacy_path}")
+    
+    def load(self):
+        """Load all users (or only this shard's), one small JSON record per row"""
+        conn = self._connect()
+        try:
+            return {
+                user_id: json.loads(data) for user_id, data in conn.execute('SELECT user_id, data FROM users')
+                if self.shard is None or shard_of(user_id, self.shard[1]) == self.shard[0]
+            }
+        finally:
+            conn.close()
+    
+    def update(self, user_id, record):
+        """Queue a user's record; serialized now so later mutations don't race the writer"""
+        self._queue(user_id, json.dumps(record))
+    
+    def _write(self, conn, batch):
+        """Upsert a batch of user records in one transaction"""
+        try:
+            with conn:
+                conn.executemany(
+                    'INSERT INTO users (user_id, data) VALUES (?, ?) '
+                    'ON CONFLICT(user_id) DO UPDATE SET data = excluded.data',
+                    batch.items()
+                )
+        except Exception as e:
+            logger.error(f"Error saving user data: {e}")
+    
+    def close(self):
+        """Stop the writer thread after it drains pending records"""
+        self._stop()
+
+class SQLitePersistence(SQLiteWriteBehind, BasePersistence):
+    """Conversation states in SQLite, pickled and written behind in batches"""
+    
+    def __init__(self, path=PERSISTENCE_PATH, shard=None, flush_interval=PERSISTENCE_FLUSH_INTERVAL,
+                 batch_size=PERSISTENCE_BATCH_SIZE):
+        # User data lives in the user store, and bot_data has no single owner once updates are sharded
+        BasePersistence.__init__(self, store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=False,
+                                                                   callback_data=False))
+        self.shard = shard
+        SQLiteWriteBehind.__init__(self, path, flush_interval, batch_size, 'PersistenceWriter')
+    
+    def _setup(self, conn):
+        with conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS conversations ('
+                'name TEXT NOT NULL, key BLOB NOT NULL, owner INTEGER NOT NULL, state BLOB NOT NULL, '
+                'PRIMARY KEY (name, key))'
+            )
+    
+    def _owns(self, owner):
+        return self.shard is None or shard_of(owner, self.shard[1]) == self.shard[0]
+    
+    def _write(self, conn, batch):
+        """Apply a batch of upserts and deletes (rows queued as None) in one transaction"""
+        upserts = [row for row in batch.values() if row is not None]
+        deletes = [key for key, row in batch.items() if row is None]
+        try:
+            with conn:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO conversations (name, key, owner, state) VALUES (?, ?, ?, ?)', upserts
+                )
+                conn.executemany('DELETE FROM conversations WHERE name = ? AND key = ?', deletes)
+        except Exception as e:
+            logger.error(f"Error saving conversation state: {e}")
+    
+    async def get_conversations(self, name):
+        conn = self._connect()
+        try:
+            rows = conn.execute('SELECT key, owner, state FROM conversations WHERE name = ?', (name,)).fetchall()
+        finally:
+            conn.close()
+        return {pickle.loads(key): pickle.loads(state) for key, owner, state in rows if self._owns(owner)}
+    
+    async def update_conversation(self, name, key, new_state):
+        # Keys are (chat_id, user_id) for the default per-chat, per-user conversation
+        encoded_key = pickle.dumps(key, pickle.HIGHEST_PROTOCOL)
+        row = None
+        if new_state is not None:
+            row = (name, encoded_key, key[-1], pickle.dumps(new_state, pickle.HIGHEST_PROTOCOL))
+        self._queue((name, encoded_key), row)
+    
+    async def get_user_data(self):
+        return {}
+    
+    async def update_user_data(self, user_id, data):
+        """User data is kept in the user store"""
+    
+    async def drop_user_data(self, user_id):
+        """User data is kept in the user store"""
+    
+    async def refresh_user_data(self, user_id, user_data):
+        """User data is kept in the user store"""
+    
+    async def get_chat_data(self):
+        return {}
+    
+    async def update_chat_data(self, chat_id, data):
+        """chat_data isn't used"""
+    
+    async def drop_chat_data(self, chat_id):
+        """chat_data isn't used"""
+    
+    async def refresh_chat_data(self, chat_id, chat_data):
+        """chat_data isn't used"""
+    
+    async def get_bot_data(self):
+        return {}
+    
+    async def update_bot_data(self, data):
+        """bot_data isn't stored"""
+    
+    async def refresh_bot_data(self, bot_data):
+        """bot_data isn't stored"""
+    
+    async def get_callback_data(self):
+        return None
+    
+    async def update_callback_data(self, data):
+        """Arbitrary callback data isn't used"""
+    
+    async def flush(self):
+        """Stop the writer thread after it drains pending rows; called when the application stops"""
+        await asyncio.to_thread(self._stop)
+
+YOUTUBE_URL_PATTERN = re.compile(
+    r'^\s*(?:https?://)?(?:'
+    r'(?:www\.|m\.|music\.)?youtube(?:-nocookie)?\.com/(?:embed|v|shorts|live)/([A-Za-z0-9_-]{11})(?:[?&#/]|\s*$)'
+    r'|(?:www\.|m\.|music\.)?youtube\.com/watch/?\?(?:[^#\s]*&)?v=([A-Za-z0-9_-]{11})(?:[&#]|\s*$)'
+    r'|youtu\.be/([A-Za-z0-9_-]{11})(?:[?&#/]|\s*$)'
+    r')'
+)
+
+def youtube_watch_url(video_id):
+    """Canonical watch URL for a video ID"""
+    return f"https://www.youtube.com/watch?v={video_id}"
+
+def fetch_youtube_metadata(video_id):
+    """Fetch a video's title, duration and English caption availability with yt-dlp"""
+    result = subprocess.run(
+        ['yt-dlp', '--dump-single-json', '--skip-download', '--no-playlist', youtube_watch_url(video_id)],
+        check=True, capture_output=True, timeout=60
+    )
+    info = json.loads(result.stdout)
+    languages = set(info.get('subtitles') or {}) | set(info.get('automatic_captions') or {})
+    return {'title': info.get('title'), 'duration': info.get('duration'), 'captions': 'en' in languages}
+
+class TTLCache:
+    """Least-recently-used cache whose entries also expire after a fixed time"""
+    
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+    
+    def get(self, key):
+        """Return a live entry and mark it recently used, or None"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+    
+    def set(self, key, value):
+        """Store an entry, evicting the least recently used one when full"""
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+class InFlight:
+    """Coalesces concurrent work by key: callers asking for a key that's already running share its task"""
+    
+    def __init__(self):
+        self.tasks = {}
+    
+    def __contains__(self, key):
+        return key in self.tasks
+    
+    def run(self, key, start):
+        """Return an awaitable for the task running for key, starting start() as one if there isn't any
+        
+        Shielded so one caller being cancelled doesn't abort the work for the others.
+        """
+        task = self.tasks.get(key)
+        if task is None:
+            task = self.tasks[key] = asyncio.create_task(start())
+            task.add_done_callback(lambda t: self.tasks.pop(key, None))
+        return asyncio.shield(task)
+
+class YouTubeResolver:
+    """Resolves YouTube links to canonical video IDs in front of a metadata cache"""
+    
+    def __init__(self, cache_size=YOUTUBE_CACHE_SIZE, ttl=YOUTUBE_CACHE_TTL, fetch=fetch_youtube_metadata):
+        self.cache = TTLCache(cache_size, ttl)
+        self.fetch = fetch
+        self.in_flight = InFlight()
+    
+    def video_id(self, url):
+        """Return the 11-character video ID for any supported link form, or None"""
+        match = YOUTUBE_URL_PATTERN.match(url)
+        if match is None:
+            return None
+        return match.group(1) or match.group(2) or match.group(3)
+    
+    def resolve_batch(self, urls):
+        """Map each URL to its video ID (None when invalid), matching every distinct URL once"""
+        resolved = {url: self.video_id(url) for url in set(urls)}
+        return [resolved[url] for url in urls]
+    
+    async def metadata(self, video_id):
+        """Return cached metadata for a video, fetching it off the event loop on a miss"""
+        metadata = self.cache.get(video_id)
+        if metadata is not None:
+            return metadata
+        
+        metadata = await self.in_flight.run(video_id, lambda: asyncio.to_thread(self.fetch, video_id))
+        self.cache.set(video_id, metadata)
+        return metadata
+
+def download_youtube_video(job_id, url, output_dir, subtitles=True):
+    """Download a YouTube video and its English subtitles with yt-dlp (runs in a worker process)"""
+    os.makedirs(output_dir, exist_ok=True)
+    output_path = os.path.join(output_dir, f"{job_id}_source.mp4")
+    subtitle_args = ['--write-subs', '--write-auto-subs', '--sub-langs', 'en', '--convert-subs', 'srt']
+    subprocess.run(
+        ['yt-dlp', '--quiet', '--no-playlist', '-f', 'mp4', '-o', output_path,
+         *(subtitle_args if subtitles else []), url],
+        check=True, capture_output=True, timeout=600
+    )
+    subtitles_path = os.path.join(output_dir, f"{job_id}_source.en.srt")
+    return output_path, subtitles_path if os.path.exists(subtitles_path) else None
+
+class ClipDetector:
+    """Finds the most engaging clip by streaming audio and low-res frames from ffmpeg in fixed windows"""
+    
+    def __init__(self, min_length=CLIP_MIN_SECONDS, max_length=CLIP_MAX_SECONDS, window=5,
+                 sample_rate=16000, fps=4, frame_size=(32, 18)):
+        self.min_length = min_length
+        self.max_length = max_length
+        self.window = window
+        self.sample_rate = sample_rate
+        self.fps = fps
+        self.frame_size = frame_size
+    
+    def _open(self, path):
+        """Start one ffmpeg process for mono PCM audio and one for tiny grayscale frames"""
+        width, height = self.frame_size
+        audio = subprocess.Popen(
+            ['ffmpeg', '-loglevel', 'error', '-i', path, '-vn', '-ac', '1', '-ar', str(self.sample_rate),
+             '-f', 's16le', 'pipe:1'],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        )
+        video = subprocess.Popen(
+            ['ffmpeg', '-loglevel', 'error', '-i', path, '-an',
+             '-vf', f'fps={self.fps},scale={width}:{height}', '-pix_fmt', 'gray', '-f', 'rawvideo', 'pipe:1'],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        )
+        return audio, video
+    
+    def _audio_scores(self, pcm, seconds):
+        """Per-second loudness and speech density from 20 ms frames"""
+        samples = np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768
+        samples = np.pad(samples, (0, seconds * self.sample_rate - len(samples)))
+        frames = samples.reshape(seconds * 50, self.sample_rate // 50)
+        
+        energy = np.sqrt(np.mean(frames ** 2, axis=1))
+        loudness = np.clip((20 * np.log10(energy.reshape(seconds, 50).mean(axis=1) + 1e-6) + 60) / 60, 0, 1)
+        
+        # Voiced speech has energy well above silence and a moderate zero-crossing rate
+        crossings = np.mean(np.abs(np.diff(np.signbit(frames), axis=1)), axis=1)
+        voiced = (energy > 0.02) & (crossings > 0.02) & (crossings < 0.25)
+        speech = voiced.reshape(seconds, 50).mean(axis=1)
+        return loudness, speech
+    
+    def _scene_scores(self, raw, seconds, previous):
+        """Per-second peak frame difference, carrying the last frame across windows"""
+        width, height = self.frame_size
+        frames = np.frombuffer(raw, dtype=np.uint8).reshape(-1, height * width).astype(np.float32)
+        if not len(frames):
+            return np.zeros(seconds), previous
+        
+        stacked = frames if previous is None else np.vstack([previous, frames])
+        diffs = np.abs(np.diff(stacked, axis=0)).mean(axis=1) / 255
+        if previous is None:
+            diffs = np.concatenate([[0.0], diffs])
+        diffs = np.pad(diffs, (0, seconds * self.fps - len(diffs)))
+        return np.clip(diffs.reshape(seconds, self.fps).max(axis=1) * 4, 0, 1), frames[-1:]
+    
+    def find_best_clip(self, path):
+        """Return the (start, end) seconds of the highest-scoring 15-45 second range"""
+        audio, video = self._open(path)
+        width, height = self.frame_size
+        audio_bytes = self.window * self.sample_rate * 2
+        video_bytes = self.window * self.fps * width * height
+        
+        # Only the last max_length seconds of scores are kept, so memory doesn't grow with the source
+        history = np.zeros(0)
+        offset = 0
+        previous = None
+        best = (-1.0, 0, self.min_length)
+        lengths = np.arange(self.min_length, self.max_length + 1)
+        try:
+            while True:
+                pcm = audio.stdout.read(audio_bytes)
+                raw = video.stdout.read(video_bytes)
+                if not pcm and not raw:
+                    break
+                
+                seconds = max(-(-len(pcm) // (self.sample_rate * 2)), -(-len(raw) // (self.fps * width * height)))
+                loudness, speech = self._audio_scores(pcm, seconds)
+                scene, previous = self._scene_scores(raw[:seconds * self.fps * width * height], seconds, previous)
+                scores = 0.4 * loudness + 0.4 * speech + 0.2 * scene
+                
+                # Score every (end, length) pair that ends in this window in one shot
+                combined = np.concatenate([history, scores])
+                prefix = np.concatenate([[0.0], np.cumsum(combined)])
+                ends = np.arange(len(history) + 1, len(combined) + 1)[:, None]
+                starts = ends - lengths[None, :]
+                valid = starts >= 0
+                means = (prefix[ends] - prefix[np.where(valid, starts, 0)]) / lengths
+                # Slightly prefer longer clips when they're about as engaging
+                bonus = 1 + 0.1 * (lengths - self.min_length) / max(self.max_length - self.min_length, 1)
+                ranked = np.where(valid, means * bonus, -1)
+                
+                index = np.unravel_index(ranked.argmax(), ranked.shape)
+                if ranked[index] > best[0]:
+                    end = offset - len(history) + int(ends[index[0], 0])
+                    best = (float(ranked[index]), end - int(lengths[index[1]]), end)
+                
+                offset += seconds
+                history = combined[-self.max_length:]
+        finally:
+            for process in (audio, video):
+                process.stdout.close()
+                process.kill()
+                process.wait()
+        
+        if offset < self.min_length:
+            return 0, offset
+        return best[1], best[2]
+
+def find_best_clip(path):
+    """Find the most engaging clip in a video (runs in a worker process)"""
+    return ClipDetector().find_best_clip(path)
+
+def worker_context():
+    """Start method for worker pools; forking a process that already runs threads can deadlock the child"""
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+def available_memory():
+    """Bytes of memory available for new processes, or None if unknown"""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+class FfmpegGovernor:
+    """Caps simultaneous ffmpeg processes by CPU count and available memory, across every job that starts them"""
+    
+    def __init__(self, limit=FFMPEG_MAX_PROCESSES, memory_per_process=FFMPEG_MEMORY_PER_PROCESS):
+        if not limit:
+            memory = available_memory()
+            limit = os.cpu_count() or 1
+            if memory is not None:
+                limit = min(limit, memory // memory_per_process)
+        self.limit = max(1, limit)
+        self.memory_per_process = memory_per_process
+        self.condition = asyncio.Condition()
+        self.running = 0
+    
+    @contextlib.asynccontextmanager
+    async def slots(self, processes=1):
+        """Hold slots for a job that runs `processes` ffmpeg processes at once (possibly in a worker process)"""
+        if not processes:
+            yield self
+            return
+        async with self.condition:
+            while True:
+                # A job needing more than the limit runs alone rather than never
+                await self.condition.wait_for(lambda: not self.running or self.running + processes <= self.limit)
+                # Hold new work back while memory is tight, unless nothing else is running
+                memory = available_memory()
+                if not self.running or memory is None or memory >= self.memory_per_process * processes:
+                    break
+                try:
+                    await asyncio.wait_for(self.condition.wait(), timeout=1)
+                except asyncio.TimeoutError:
+                    pass
+            self.running += processes
+        try:
+            yield self
+        finally:
+            async with self.condition:
+                self.running -= processes
+                self.condition.notify_all()
+
+class TranscodeCache:
+    """Transcoded Reels keyed on (video ID, clip range, preset), with identical requests coalesced"""
+    
+    def __init__(self, root=TRANSCODE_DIR, governor=None):
+        self.root = root
+        self.governor = governor or FfmpegGovernor()
+        self.in_flight = InFlight()
+        os.makedirs(root, exist_ok=True)
+        
+        self.conn = sqlite3.connect(os.path.join(root, 'index.db'))
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS clips (video_id TEXT PRIMARY KEY, path TEXT NOT NULL)'
+            )
+    
+    def output_path(self, video_id, start, end, preset):
+        """Deterministic output file for a transcode key"""
+        key = hashlib.sha1(f"{video_id}:{start}:{end}:{preset}".encode()).hexdigest()
+        return os.path.join(self.root, key[:2], f"{key}.mp4")
+    
+    def lookup(self, video_id):
+        """Return the last finished Reel for a video if it's still on disk"""
+        row = self.conn.execute('SELECT path FROM clips WHERE video_id = ?', (video_id,)).fetchone()
+        return row[0] if row and os.path.exists(row[0]) else None
+    
+    async def transcode(self, video_id, start, end, source_path, subtitles_path=None, preset='reel'):
+        """Return a Reel for the clip, reusing a finished file or joining an identical in-flight job"""
+        path = self.output_path(video_id, start, end, f"{preset}+subs" if subtitles_path else preset)
+        
+        if not os.path.exists(path):
+            await self.in_flight.run(path, lambda: self._run(path, start, end, source_path, subtitles_path, preset))
+        
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO clips (video_id, path) VALUES (?, ?)', (video_id, path))
+        return path
+    
+    async def _run(self, path, start, end, source_path, subtitles_path, preset):
+        """Run ffmpeg under the governor and move the result into place when it succeeds"""
+        filters = REEL_PRESETS[preset]['filters']
+        if subtitles_path:
+            # Subtitles are timed against the full video, so shift back to source time around the filter
+            filters = f"setpts=PTS+{start}/TB,subtitles={subtitles_path},setpts=PTS-STARTPTS,{filters}"
+        
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.part.mp4"
+        async with self.governor.slots():
+            process = await asyncio.create_subprocess_exec(
+                'ffmpeg', '-y', '-loglevel', 'error', '-ss', str(start), '-i', source_path, '-t', str(end - start),
+                '-vf', filters, *REEL_PRESETS[preset]['codec'], tmp_path,
+                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+            )
+            try:
+                _, stderr = await process.communicate()
+            except asyncio.CancelledError:
+                process.kill()
+                await process.wait()
+                raise
+        
+        if process.returncode:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise RuntimeError(f"ffmpeg exited with {process.returncode}: {stderr.decode(errors='replace')[-500:]}")
+        os.replace(tmp_path, path)
+    
+    def close(self):
+        """Close the index database"""
+        self.conn.close()
+
+class BackgroundJobs:
+    """Jobs that run after their handler has replied, capped in total and per user"""
+    
+    def __init__(self, max_pending, max_per_user):
+        self.max_pending = max_pending
+        self.max_per_user = max_per_user
+        self.per_user = {}
+        self.tasks = set()
+    
+    def submit(self, user_id, job, *args):
+        """Start job(job_id, *args) in the background; return the job ID, or None if the queue is full"""
+        if len(self.tasks) >= self.max_pending or self.per_user.get(user_id, 0) >= self.max_per_user:
+            return None
+        
+        job_id = f"{user_id}_{int(time.time() * 1000)}"
+        self.per_user[user_id] = self.per_user.get(user_id, 0) + 1
+        task = asyncio.create_task(job(job_id, *args))
+        self.tasks.add(task)
+        task.add_done_callback(lambda t: self._job_done(user_id, t))
+        return job_id
+    
+    def _job_done(self, user_id, task):
+        """Release the user's slot once a job finishes"""
+        self.tasks.discard(task)
+        self.per_user[user_id] -= 1
+        if not self.per_user[user_id]:
+            del self.per_user[user_id]
+    
+    async def shutdown(self):
+        """Cancel running jobs"""
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+class VideoJobPool(BackgroundJobs):
+    """Bounded pool of worker processes for YouTube download and clip detection jobs"""
+    
+    def __init__(self, workers=VIDEO_WORKERS, max_pending=MAX_PENDING_VIDEO_JOBS,
+                 max_per_user=MAX_VIDEO_JOBS_PER_USER, output_dir=REELS_DIR):
+        super().__init__(max_pending, max_per_user)
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=worker_context())
+        self.output_dir = output_dir
+    
+    async def run(self, func, *args):
+        """Run a blocking function in a worker process"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+    
+    async def shutdown(self):
+        """Cancel running jobs and stop the worker processes"""
+        await super().shutdown()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+class PublishError(Exception):
+    """A publishing step failed and retrying it won't help"""
+
+class PublishUncertain(PublishError):
+    """A non-idempotent call failed in a way that doesn't say whether the server acted on it"""
+
+class InstagramPublisher:
+    """Publishes queued posts through the Instagram Graph API, serialized per account and run in worker threads"""
+    
+    RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+    VIDEO_EXTENSIONS = frozenset({'.mp4', '.mov', '.m4v'})
+    
+    def __init__(self, base_url=INSTAGRAM_GRAPH_URL, accounts_path=INSTAGRAM_ACCOUNTS_PATH, media_root=MEDIA_CACHE_DIR,
+                 media_url=MEDIA_PUBLIC_URL, concurrency=PUBLISH_CONCURRENCY, chunk_size=UPLOAD_CHUNK_SIZE,
+                 max_retries=PUBLISH_MAX_RETRIES, backoff=1.0, poll_interval=2.0, poll_timeout=600):
+        self.base_url = base_url.rstrip('/')
+        self.accounts_path = accounts_path
+        self.media_root = media_root
+        self.media_url = media_url.rstrip('/') if media_url else None
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.poll_interval = poll_interval
+        self.poll_timeout = poll_timeout
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='Publisher')
+        self.sessions = OrderedDict()
+        self.sessions_lock = threading.Lock()
+        self.locks = {}
+        self.accounts = {}
+        self.accounts_mtime = None
+    
+    def credentials(self, account):
+        """Instagram user ID and access token linked to a Telegram user ID; the file is re-read when it changes"""
+        try:
+            mtime = os.stat(self.accounts_path).st_mtime
+        except OSError:
+            mtime = None
+        if mtime != self.accounts_mtime:
+            self.accounts = {}
+            if mtime is not None:
+                with open(self.accounts_path, 'r') as f:
+                    self.accounts = json.load(f)
+            self.accounts_mtime = mtime
+        
+        credentials = self.accounts.get(str(account))
+        if not credentials:
+            raise PublishError(f"No Instagram account is linked for {account}")
+        return credentials
+    
+    def session(self, account):
+        """Keep-alive session for an account; the least recently used ones are closed past PUBLISH_SESSIONS"""
+        with self.sessions_lock:
+            session = self.sessions.pop(account, None)
+            if session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=2)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+            self.sessions[account] = session
+            while len(self.sessions) > PUBLISH_SESSIONS:
+                self.sessions.popitem(last=False)[1].close()
+        return session
+    
+    async def publish(self, account, payload):
+        """Publish one queued post and return its Instagram media ID (None if it went live but the ID was lost)"""
+        return await self._run(account, self._publish, payload)
+    
+    async def insights(self, account, media_id):
+        """Lifetime views and engagement rate (interactions per view) of a published post"""
+        return await self._run(account, self._insights, media_id)
+    
+    async def _run(self, account, function, *args):
+        """Run function(account, credentials, *args) in a worker thread, one call per account at a time"""
+        credentials = self.credentials(account)
+        # Entry is [lock, number of calls holding or waiting for it], as in PerUserUpdateProcessor
+        entry = self.locks.setdefault(account, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self.executor, function, account, credentials, *args)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[account]
+    
+    def _insights(self, account, credentials, media_id):
+        """Fetch a post's insights (runs in a worker thread)"""
+        response = self._graph(
+            self.session(account), credentials, 'GET', f"{media_id}/insights",
+            params={'metric': 'views,total_interactions'}
+        )
+        values = {}
+        for metric in response.get('data', []):
+            # Lifetime metrics come either as total_value or as a single-entry values list
+            if 'total_value' in metric:
+                values[metric['name']] = metric['total_value']['value']
+            elif metric.get('values'):
+                values[metric['name']] = metric['values'][0]['value']
+        views = float(values.get('views', 0))
+        return views, float(values.get('total_interactions', 0)) / views if views else 0.0
+    
+    def _publish(self, account, credentials, payload):
+        """Create the media container(s), wait for processing and publish (runs in a worker thread)"""
+        session = self.session(account)
+        caption = f"{payload['caption']}\n\n{payload['hashtags']}".strip()
+        user_id = credentials['user_id']
+        
+        if len(payload['media']) == 1:
+            container = self._create_container(session, credentials, payload['media'][0], caption=caption)
+        else:
+            children = [
+                self._create_container(session, credentials, path, carousel_item=True) for path in payload['media']
+            ]
+            container = self._graph(session, credentials, 'POST', f"{user_id}/media", data={
+                'media_type': 'CAROUSEL', 'children': ','.join(children), 'caption': caption
+            })['id']
+        
+        self._wait_until_ready(session, credentials, container)
+        # Publishing isn't idempotent: after an ambiguous failure, check the container before trying again
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self._graph(
+                    session, credentials, 'POST', f"{user_id}/media_publish", data={'creation_id': container},
+                    resend=False
+                )['id']
+            except PublishUncertain:
+                if self._status(session, credentials, container) == 'PUBLISHED':
+                    # The post is live but the reply with its media ID was lost. The container ID
+                    # can't stand in for it, so the post goes unmeasured rather than failing insights
+                    return None
+                if attempt == self.max_retries:
+                    raise
+                self._sleep(attempt)
+    
+    def _create_container(self, session, credentials, path, caption=None, carousel_item=False):
+        """Create a media container; videos are uploaded to it in resumable chunks"""
+        data = {'caption': caption} if caption else {}
+        if carousel_item:
+            data['is_carousel_item'] = 'true'
+        
+        if os.path.splitext(path)[1].lower() in self.VIDEO_EXTENSIONS:
+            data.update(media_type='VIDEO' if carousel_item else 'REELS', upload_type='resumable')
+            container = self._graph(session, credentials, 'POST', f"{credentials['user_id']}/media", data=data)
+            self._upload(session, container['uri'], path, credentials['access_token'])
+            if carousel_item:
+                # The carousel can only be created from children that have finished processing
+                self._wait_until_ready(session, credentials, container['id'])
+            return container['id']
+        
+        # Instagram fetches photos itself, from wherever the media cache is served
+        if not self.media_url:
+            raise PublishError("Set MEDIA_PUBLIC_URL to where the media cache is served so Instagram can fetch photos")
+        relative = os.path.relpath(path, self.media_root).replace(os.sep, '/')
+        if relative.startswith('../'):
+            raise PublishError(f"{path} is outside MEDIA_CACHE_DIR, so Instagram can't fetch it")
+        data['image_url'] = f"{self.media_url}/{urllib.parse.quote(relative)}"
+        return self._graph(session, credentials, 'POST', f"{credentials['user_id']}/media", data=data)['id']
+    
+    def _upload(self, session, uri, path, access_token):
+        """Send a file in chunks; after a failure, ask the server how much arrived and continue from there"""
+        size = os.path.getsize(path)
+        headers = {'Authorization': f'OAuth {access_token}', 'file_size': str(size)}
+        offset = 0
+        failures = 0
+        with open(path, 'rb') as f:
+            while offset < size:
+                f.seek(offset)
+                chunk = f.read(self.chunk_size)
+                try:
+                    response = session.post(
+                        uri, data=chunk, headers={**headers, 'offset': str(offset)}, timeout=(10, 120)
+                    )
+                    if response.status_code in self.RETRY_STATUSES:
+                        raise requests.ConnectionError(f"HTTP {response.status_code}")
+                    if not response.ok:
+                        raise PublishError(f"Upload of {path} rejected: {response.status_code} {response.text[:200]}")
+                    offset += len(chunk)
+                    failures = 0
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    failures += 1
+                    if failures > self.max_retries:
+                        raise PublishError(f"Upload of {path} stalled at byte {offset}: {e}")
+                    self._sleep(failures - 1)
+                    offset = self._uploaded_bytes(session, uri, headers, offset)
+    
+    def _uploaded_bytes(self, session, uri, headers, fallback):
+        """How many bytes the upload endpoint has stored; part of a failed chunk may have made it"""
+        try:
+            response = session.get(uri, headers=headers, timeout=(10, 30))
+            response.raise_for_status()
+            return int(response.json()['offset'])
+        except (requests.RequestException, KeyError, ValueError):
+            return fallback
+    
+    def _wait_until_ready(self, session, credentials, container):
+        """Poll a container until Instagram has finished processing it"""
+        deadline = time.monotonic() + self.poll_timeout
+        while True:
+            status = self._status(session, credentials, container)
+            if status == 'FINISHED':
+                return
+            if status in ('ERROR', 'EXPIRED'):
+                raise PublishError(f"Instagram couldn't process container {container}: {status}")
+            if time.monotonic() > deadline:
+                raise PublishError(f"Container {container} still {status} after {self.poll_timeout}s")
+            time.sleep(self.poll_interval)
+    
+    def _status(self, session, credentials, container):
+        return self._graph(
+            session, credentials, 'GET', container, params={'fields': 'status_code'}
+        ).get('status_code', 'FINISHED')
+    
+    def _graph(self, session, credentials, method, endpoint, params=None, data=None, resend=True):
+        """Call a Graph API endpoint, retrying throttling, server errors and network failures with backoff"""
+        url = f"{self.base_url}/{endpoint}"
+        params = {**(params or {}), 'access_token': credentials['access_token']}
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = session.request(method, url, params=params, data=data, timeout=(10, 60))
+            except requests.ConnectTimeout as e:
+                error = e
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if not resend:
+                    raise PublishUncertain(f"{method} {endpoint} may or may not have gone through: {e}")
+                error = e
+            else:
+                if response.status_code not in self.RETRY_STATUSES:
+                    if not response.ok:
+                        raise PublishError(f"{method} {endpoint} failed: {response.status_code} {response.text[:200]}")
+                    return response.json()
+                error = f"HTTP {response.status_code}"
+                if response.status_code != 429 and not resend:
+                    raise PublishUncertain(f"{method} {endpoint} may or may not have gone through: {error}")
+            
+            if attempt < self.max_retries:
+                self._sleep(attempt)
+        raise PublishError(f"{method} {endpoint} failed after {self.max_retries + 1} attempts: {error}")
+    
+    def _sleep(self, attempt):
+        """Exponential backoff with jitter, capped at a minute"""
+        time.sleep(min(self.backoff * 2 ** attempt, 60) * random.uniform(0.5, 1))
+    
+    def close(self):
+        """Stop the worker threads and close every pooled connection"""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        with self.sessions_lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+
+class UploadScheduler:
+    """Durable upload queue that posts each item when it falls due"""
+    
+    def __init__(self, path=UPLOAD_QUEUE_PATH, publish=None, daily_limit=DAILY_POST_LIMIT,
+                 max_queued=MAX_QUEUED_PER_ACCOUNT, interval=POST_INTERVAL_MINUTES * 60, shard=None):
+        self.path = path
+        self.shard = shard
+        self.publish = publish
+        self.daily_limit = daily_limit
+        self.max_queued = max_queued
+        self.interval = interval
+        self.best_hour = lambda account: DEFAULT_POST_HOUR
+        self.heap = []
+        self.queued = {}
+        self.last_scheduled = {}
+        self.scheduled_per_day = {}
+        self.posted_per_day = {}
+        self.publishing = set()
+        self.wakeup = asyncio.Event()
+        
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS uploads ('
+                'id INTEGER PRIMARY KEY, account TEXT NOT NULL, chat_id INTEGER, scheduled_at REAL NOT NULL, '
+                'status TEXT NOT NULL, payload TEXT NOT NULL, posted_at REAL, media_id TEXT, measured_at REAL)'
+            )
+            # Queues created before publishing results were tracked
+            columns = {row[1] for row in self.conn.execute('PRAGMA table_info(uploads)')}
+            for column, definition in (('media_id', 'TEXT'), ('measured_at', 'REAL')):
+                if column not in columns:
+                    self.conn.execute(f'ALTER TABLE uploads ADD COLUMN {column} {definition}')
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS uploads_pending ON uploads (scheduled_at) WHERE status = 'pending'"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS uploads_posted ON uploads (posted_at) WHERE status = 'posted'"
+            )
+            self.conn.execute(
+                'CREATE INDEX IF NOT EXISTS uploads_unmeasured ON uploads (posted_at) '
+                "WHERE status = 'posted' AND measured_at IS NULL AND media_id IS NOT NULL"
+            )
+        self._recover()
+    
+    def _owns(self, account):
+        return self.shard is None or shard_of(account, self.shard[1]) == self.shard[0]
+    
+    def _recover(self):
+        """Rebuild the heap from pending rows and today's counters from posted rows, for this shard's accounts"""
+        rows = [
+            row for row in self.conn.execute(
+                "SELECT id, account, chat_id, scheduled_at, payload FROM uploads WHERE status = 'pending'"
+            )
+            if self._owns(row[1])
+        ]
+        for upload_id, account, chat_id, scheduled_at, payload in rows:
+            self._track(upload_id, account, chat_id, scheduled_at, json.loads(payload))
+        
+        midnight = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+        today = datetime.now().date()
+        for account, count in self.conn.execute(
+            "SELECT account, COUNT(*) FROM uploads WHERE status = 'posted' AND posted_at >= ? GROUP BY account",
+            (midnight,)
+        ):
+            if self._owns(account):
+                self.posted_per_day[(account, today)] = count
+        
+        if rows:
+            logger.info(f"Recovered {len(rows)} pending uploads")
+    
+    def _track(self, upload_id, account, chat_id, scheduled_at, payload):
+        """Add a pending item to the in-memory indexes"""
+        heapq.heappush(self.heap, (scheduled_at, upload_id, account, chat_id, payload))
+        self.queued[account] = self.queued.get(account, 0) + 1
+        self.last_scheduled[account] = max(self.last_scheduled.get(account, 0), scheduled_at)
+        day = (account, datetime.fromtimestamp(scheduled_at).date())
+        self.scheduled_per_day[day] = self.scheduled_per_day.get(day, 0) + 1
+    
+    def _next_slot(self, account, after):
+        """Find the next optimal posting time that doesn't exceed the daily cap"""
+        last = self.last_scheduled.get(account)
+        if last is not None and last + self.interval > after:
+            slot = datetime.fromtimestamp(last + self.interval)
+        else:
+            slot = datetime.fromtimestamp(after).replace(
+                hour=self.best_hour(account), minute=0, second=0, microsecond=0
+            )
+            if slot.timestamp() < after:
+                slot += timedelta(days=1)
+        
+        while self.scheduled_per_day.get((account, slot.date()), 0) >= self.daily_limit:
+            slot = (slot + timedelta(days=1)).replace(hour=self.best_hour(account), minute=0, second=0, microsecond=0)
+        
+        return slot.timestamp()
+    
+    def add(self, account, chat_id, payload):
+        """Queue an item for posting; returns the scheduled time, or None if the account's queue is full"""
+        if self.queued.get(account, 0) >= self.max_queued:
+            return None
+        
+        scheduled_at = self._next_slot(account, time.time())
+        with self.conn:
+            cursor = self.conn.execute(
+                "INSERT INTO uploads (account, chat_id, scheduled_at, status, payload) VALUES (?, ?, ?, 'pending', ?)",
+                (account, chat_id, scheduled_at, json.dumps(payload))
+            )
+        self._track(cursor.lastrowid, account, chat_id, scheduled_at, payload)
+        
+        # Wake the run loop if this item is now the next one due
+        if self.heap[0][1] == cursor.lastrowid:
+            self.wakeup.set()
+        
+        return datetime.fromtimestamp(scheduled_at)
+    
+    def posts_today(self, account):
+        """Number of items posted for the account today"""
+        return self.posted_per_day.get((account, datetime.now().date()), 0)
+    
+    async def run(self):
+        """Sleep until the next item is due, then start publishing it"""
+        while True:
+            self.wakeup.clear()
+            if not self.heap:
+                await self.wakeup.wait()
+                continue
+            
+            delay = self.heap[0][0] - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            scheduled_at, upload_id, account, chat_id, payload = heapq.heappop(self.heap)
+            day = (account, datetime.fromtimestamp(scheduled_at).date())
+            self.scheduled_per_day[day] -= 1
+            self.queued[account] -= 1
+            
+            # Cap reached (e.g. by items posted before a restart); push to the next free day
+            if self.posts_today(account) >= self.daily_limit:
+                scheduled_at = self._next_slot(account, time.time() + 86400)
+                with self.conn:
+                    self.conn.execute('UPDATE uploads SET scheduled_at = ? WHERE id = ?', (scheduled_at, upload_id))
+                self._track(upload_id, account, chat_id, scheduled_at, payload)
+                continue
+            
+            # Publish in the background so a slow upload for one account doesn't hold up the others;
+            # count it against today's cap now so items published alongside it see it
+            today = (account, datetime.now().date())
+            self.posted_per_day[today] = self.posted_per_day.get(today, 0) + 1
+            task = asyncio.create_task(self._publish(upload_id, account, chat_id, payload, today))
+            self.publishing.add(task)
+            task.add_done_callback(self.publishing.discard)
+    
+    async def _publish(self, upload_id, account, chat_id, payload, today):
+        """Publish one item and record the outcome"""
+        media_id = None
+        try:
+            if self.publish:
+                media_id = await self.publish(account, chat_id, payload)
+            status = 'posted'
+        except Exception as e:
+            logger.error(f"Error publishing upload {upload_id}: {e}")
+            status = 'failed'
+            self.posted_per_day[today] -= 1
+        
+        with self.conn:
+            self.conn.execute(
+                'UPDATE uploads SET status = ?, posted_at = ?, media_id = ? WHERE id = ?',
+                (status, time.time(), media_id, upload_id)
+            )
+    
+    def unmeasured(self, posted_before):
+        """Published items from before the given time whose metrics haven't been collected, for this shard's accounts"""
+        rows = self.conn.execute(
+            'SELECT id, account, posted_at, media_id, payload FROM uploads '
+            "WHERE status = 'posted' AND measured_at IS NULL AND media_id IS NOT NULL AND posted_at <= ? "
+            'ORDER BY posted_at', (posted_before,)
+        )
+        return [
+            (upload_id, account, posted_at, media_id, json.loads(payload))
+            for upload_id, account, posted_at, media_id, payload in rows if self._owns(account)
+        ]
+    
+    def mark_measured(self, upload_id):
+        """Record that an item's metrics have been collected (or given up on)"""
+        with self.conn:
+            self.conn.execute('UPDATE uploads SET measured_at = ? WHERE id = ?', (time.time(), upload_id))
+    
+    async def drain(self):
+        """Wait for items already being published; cancelling them could leave a post live but still pending"""
+        await asyncio.gather(*self.publishing, return_exceptions=True)
+    
+    def close(self):
+        """Close the queue database"""
+        self.conn.close()
+
+def closest_aspect_ratio(width, height):
+    """Pick the Instagram aspect ratio (width / height) nearest to the source"""
+    ratio = width / height
+    return min(INSTAGRAM_ASPECT_RATIOS, key=lambda target: abs(math.log(ratio / target)))
+
+def preprocess_image(data, output_path, thumb_path):
+    """Crop or pad an image to an Instagram aspect ratio, recompress it and write a thumbnail"""
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(data))).convert('RGB')
+    width, height = image.size
+    target = closest_aspect_ratio(width, height)
+    size = (MEDIA_OUTPUT_WIDTH, round(MEDIA_OUTPUT_WIDTH / target))
+    
+    # Crop when little is lost, otherwise pad so nothing important is cut off
+    kept = min(width / height, target) / max(width / height, target)
+    if 1 - kept <= MAX_CROP_LOSS:
+        image = ImageOps.fit(image, size, Image.LANCZOS)
+    else:
+        image = ImageOps.pad(image, size, Image.LANCZOS, color=(0, 0, 0))
+    
+    image.save(output_path, 'JPEG', quality=85, optimize=True, progressive=True)
+    image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+    image.save(thumb_path, 'JPEG', quality=80)
+
+def preprocess_video(data, output_path, thumb_path, width, height):
+    """Fit a video into an Instagram frame with ffmpeg, reading it from memory, and grab a thumbnail"""
+    target = closest_aspect_ratio(width, height) if width and height else 9 / 16
+    out_width, out_height = MEDIA_OUTPUT_WIDTH, round(MEDIA_OUTPUT_WIDTH / target)
+    
+    # MP4s often keep their index at the end, so ffmpeg needs a seekable input; an in-memory
+    # file gives it one without touching disk. Fall back to a pipe where memfd isn't available.
+    memfd = os.memfd_create('upload') if hasattr(os, 'memfd_create') else None
+    try:
+        if memfd is not None:
+            os.write(memfd, data)
+            source, stdin, pass_fds = f'/dev/fd/{memfd}', None, (memfd,)
+        else:
+            source, stdin, pass_fds = 'pipe:0', data, ()
+        subprocess.run(
+            ['ffmpeg', '-y', '-loglevel', 'error', '-i', source,
+             '-vf', f'scale={out_width}:{out_height}:force_original_aspect_ratio=decrease,'
+                    f'pad={out_width}:{out_height}:(ow-iw)/2:(oh-ih)/2',
+             '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23', '-c:a', 'aac', '-movflags', '+faststart',
+             output_path],
+            input=stdin, pass_fds=pass_fds, check=True, capture_output=True, timeout=600
+        )
+    finally:
+        if memfd is not None:
+            os.close(memfd)
+    
+    subprocess.run(
+        ['ffmpeg', '-y', '-loglevel', 'error', '-i', output_path, '-frames:v', '1',
+         '-vf', f'scale={THUMBNAIL_SIZE}:-2', thumb_path],
+        check=True, capture_output=True, timeout=60
+    )
+
+def part_path(path):
+    """Per-process temporary name next to `path`, keeping the extension so encoders can infer the format"""
+    base, ext = os.path.splitext(path)
+    return f"{base}.{os.getpid()}.part{ext}"
+
+def preprocess_media(data, kind, output_path, thumb_path, width=None, height=None):
+    """Write the final artifacts for one upload (runs in a worker process)"""
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    # Write under temporary names and move into place, so a reader never sees a half-written file
+    tmp_output, tmp_thumb = part_path(output_path), part_path(thumb_path)
+    try:
+        if kind == 'photo':
+            preprocess_image(data, tmp_output, tmp_thumb)
+        elif kind == 'video':
+            preprocess_video(data, tmp_output, tmp_thumb, width, height)
+        if kind in ('photo', 'video'):
+            os.replace(tmp_thumb, thumb_path)
+            os.replace(tmp_output, output_path)
+            return
+    except Exception as e:
+        # Keep the original when ffmpeg or Pillow can't decode it (e.g. a truncated or unusual container)
+        logger.warning(f"Preprocessing failed, storing original: {e}")
+        for stale in (tmp_output, tmp_thumb):
+            try:
+                os.remove(stale)
+            except FileNotFoundError:
+                pass
+    
+    with open(tmp_output, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_output, output_path)
+
+def dhash(gray):
+    """64-bit difference hashes of 8x9 grayscale arrays: one bit per horizontally adjacent pixel pair"""
+    bits = gray[..., 1:] > gray[..., :-1]
+    return np.packbits(bits.reshape(-1, 64), axis=1).view('>u8').ravel().astype(np.uint64)
+
+def perceptual_hashes(path, kind, keyframes=VIDEO_KEYFRAMES):
+    """Hash a processed photo, or up to `keyframes` evenly spaced video keyframes (runs in a worker process)"""
+    if kind == 'photo':
+        with Image.open(path) as image:
+            gray = np.asarray(image.convert('L').resize((9, 8), Image.LANCZOS))
+        return dhash(gray).tolist()
+    if kind != 'video':
+        return []
+    
+    # Decode only keyframes and shrink them straight to hash size
+    result = subprocess.run(
+        ['ffmpeg', '-loglevel', 'error', '-skip_frame', 'nokey', '-i', path,
+         '-vf', 'scale=9:8:flags=area,format=gray', '-vsync', 'passthrough', '-f', 'rawvideo', 'pipe:1'],
+        check=True, capture_output=True, timeout=300
+    )
+    frames = np.frombuffer(result.stdout, dtype=np.uint8)
+    frames = frames[:len(frames) // 72 * 72].reshape(-1, 8, 9)
+    hashes = dhash(frames)
+    # Flat frames (fades, black screens) hash to zero and would match every other video
+    hashes = hashes[hashes != 0]
+    if len(hashes) > keyframes:
+        hashes = hashes[np.linspace(0, len(hashes) - 1, keyframes).round().astype(int)]
+    return hashes.tolist()
+
+class MediaCache:
+    """Content-addressed media store keyed on Telegram file_unique_id and SHA-256, with LRU eviction"""
+    
+    def __init__(self, root=MEDIA_CACHE_DIR, max_bytes=MEDIA_CACHE_MAX_BYTES, workers=PREPROCESS_WORKERS,
+                 governor=None, shard=None):
+        # Shard workers keep their caches inside root (root/shard1/...), so serving root publishes all of them
+        self.base_root = root
+        self.root = os.path.join(root, f"shard{shard[0]}") if shard else root
+        self.max_bytes = max_bytes
+        self.governor = governor or FfmpegGovernor()
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=worker_context())
+        self.downloads = 0
+        self.in_flight = InFlight()
+        os.makedirs(self.root, exist_ok=True)
+        
+        self.conn = sqlite3.connect(os.path.join(self.root, 'index.db'))
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS blobs ('
+                'hash TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER NOT NULL, '
+                'last_access REAL NOT NULL, refs INTEGER NOT NULL DEFAULT 0)'
+            )
+            self.conn.execute('CREATE INDEX IF NOT EXISTS blobs_lru ON blobs (last_access) WHERE refs = 0')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS aliases (file_unique_id TEXT PRIMARY KEY, hash TEXT NOT NULL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS aliases_hash ON aliases (hash)')
+        self.total_bytes = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+    
+    def shard_path(self, digest, ext):
+        """Spread files over 65536 subdirectories using the first two bytes of the hash"""
+        return os.path.join(self.root, digest[:2], digest[2:4], f"{digest}.{ext}")
+    
+    def get(self, file_unique_id):
+        """Return the cached path for a Telegram file and pin it, or None on a miss"""
+        row = self.conn.execute(
+            'SELECT blobs.hash, blobs.path FROM aliases JOIN blobs ON blobs.hash = aliases.hash '
+            'WHERE aliases.file_unique_id = ?', (file_unique_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        
+        digest, path = row
+        if not os.path.exists(path):
+            self._forget(digest)
+            return None
+        
+        with self.conn:
+            self.conn.execute(
+                'UPDATE blobs SET last_access = ?, refs = refs + 1 WHERE hash = ?', (time.time(), digest)
+            )
+        return path
+    
+    def _pin_hash(self, digest, file_unique_id):
+        """Pin an already stored blob and alias it to a new file_unique_id"""
+        row = self.conn.execute('SELECT path FROM blobs WHERE hash = ?', (digest,)).fetchone()
+        if row is None or not os.path.exists(row[0]):
+            return None
+        
+        with self.conn:
+            self.conn.execute(
+                'UPDATE blobs SET last_access = ?, refs = refs + 1 WHERE hash = ?', (time.time(), digest)
+            )
+            self.conn.execute(
+                'INSERT OR REPLACE INTO aliases (file_unique_id, hash) VALUES (?, ?)', (file_unique_id, digest)
+            )
+        return row[0]
+    
+    def _add(self, digest, path, file_unique_id):
+        """Pin freshly written artifacts (output and thumbnail), recording the blob if no other fetch has yet"""
+        thumb_path = self.shard_path(digest, 'thumb.jpg')
+        size = os.path.getsize(path) + (os.path.getsize(thumb_path) if os.path.exists(thumb_path) else 0)
+        new = self.conn.execute('SELECT 1 FROM blobs WHERE hash = ?', (digest,)).fetchone() is None
+        with self.conn:
+            self.conn.execute(
+                'INSERT INTO blobs (hash, path, size, last_access, refs) VALUES (?, ?, ?, ?, 1) '
+                'ON CONFLICT (hash) DO UPDATE SET last_access = excluded.last_access, refs = refs + 1',
+                (digest, path, size, time.time())
+            )
+            self.conn.execute(
+                'INSERT OR REPLACE INTO aliases (file_unique_id, hash) VALUES (?, ?)', (file_unique_id, digest)
+            )
+        if new:
+            self.total_bytes += size
+        self.evict()
+    
+    async def fetch(self, media, kind, ext):
+        """Return the processed local path for a Telegram media object, downloading it only on a cache miss"""
+        path = self.get(media.file_unique_id)
+        if path:
+            return path
+        
+        self.downloads += 1
+        try:
+            # Download into memory; hash through a memoryview so the buffer isn't copied
+            file = await media.get_file()
+            data = await file.download_as_bytearray()
+            digest = await asyncio.to_thread(lambda: hashlib.sha256(memoryview(data)).hexdigest())
+            
+            path = self._pin_hash(digest, media.file_unique_id)
+            if path:
+                return path
+            
+            # The same content arriving twice at once (e.g. a forwarded post) is preprocessed once;
+            # every caller then takes its own pin
+            path = await self.in_flight.run(digest, lambda: self._preprocess(digest, data, kind, ext, media))
+            self._add(digest, path, media.file_unique_id)
+            return path
+        finally:
+            self.downloads -= 1
+    
+    async def _preprocess(self, digest, data, kind, ext, media):
+        """Crop/pad, recompress and thumbnail in a worker process; only the results touch disk"""
+        if kind == 'photo':
+            ext = 'jpg'
+        path = self.shard_path(digest, ext)
+        loop = asyncio.get_running_loop()
+        # Videos run ffmpeg (one process at a time) in the worker
+        async with self.governor.slots(1 if kind == 'video' else 0):
+            await loop.run_in_executor(
+                self.executor, preprocess_media, data, kind, path, self.shard_path(digest, 'thumb.jpg'),
+                getattr(media, 'width', None), getattr(media, 'height', None)
+            )
+        return path
+    
+    def release(self, path):
+        """Unpin a file once it's no longer queued, making it eligible for eviction"""
+        # Files live at root/ab/cd/<hash>.ext; one from another shard's cache was queued before a
+        # change to SHARDS moved its user here, so it's unpinned in the cache that holds it
+        root = os.path.abspath(os.path.dirname(os.path.dirname(os.path.dirname(path))))
+        own_root = os.path.abspath(self.root)
+        base_root = os.path.abspath(self.base_root)
+        if root == own_root or not re.fullmatch(rf'{re.escape(base_root)}({re.escape(os.sep)}shard\d+)?', root):
+            with self.conn:
+                self.conn.execute('UPDATE blobs SET refs = MAX(refs - 1, 0) WHERE path = ?', (path,))
+            return
+        
+        try:
+            conn = sqlite3.connect(f"file:{os.path.join(root, 'index.db')}?mode=rw", uri=True, timeout=30)
+            try:
+                with conn:
+                    conn.execute('UPDATE blobs SET refs = MAX(refs - 1, 0) WHERE path = ?', (path,))
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logger.warning(f"Couldn't release {path} in {root}: {e}")
+    
+    def evict(self):
+        """Delete least recently used unpinned files until the store fits in max_bytes"""
+        while self.total_bytes > self.max_bytes:
+            row = self.conn.execute(
+                'SELECT hash, path FROM blobs WHERE refs = 0 ORDER BY last_access LIMIT 1'
+            ).fetchone()
+            if row is None:
+                break
+            
+            digest, path = row
+            for stale in (path, self.shard_path(digest, 'thumb.jpg')):
+                try:
+                    os.remove(stale)
+                except FileNotFoundError:
+                    pass
+            self._forget(digest)
+    
+    def _forget(self, digest):
+        """Drop a blob and its aliases from the index"""
+        size = self.conn.execute('SELECT size FROM blobs WHERE hash = ?', (digest,)).fetchone()[0]
+        with self.conn:
+            self.conn.execute('DELETE FROM blobs WHERE hash = ?', (digest,))
+            self.conn.execute('DELETE FROM aliases WHERE hash = ?', (digest,))
+        self.total_bytes -= size
+    
+    def close(self):
+        """Close the index database and stop the preprocessing workers"""
+        self.conn.close()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+class AlbumCollector:
+    """Collects album items sharing a media_group_id, downloading them as they arrive, and finishes each album once"""
+    
+    def __init__(self, on_complete, window=ALBUM_COLLECT_SECONDS, concurrency=ALBUM_DOWNLOAD_CONCURRENCY):
+        self.on_complete = on_complete
+        self.window = window
+        self.concurrency = concurrency
+        self.albums = {}
+        self.tasks = set()
+    
+    def __contains__(self, media_group_id):
+        return media_group_id in self.albums
+    
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+    
+    def add(self, media_group_id, update, download, *args):
+        """Start download(*args) for one item; the album completes once no item has arrived for the window"""
+        album = self.albums.get(media_group_id)
+        if album is None:
+            album = self.albums[media_group_id] = {
+                'items': [], 'semaphore': asyncio.Semaphore(self.concurrency), 'deadline': 0.0
+            }
+            self._spawn(self._finish_when_quiet(media_group_id))
+        if len(album['items']) >= MAX_CAROUSEL_ITEMS:
+            return False
+        
+        album['items'].append((update.message.message_id, update, self._spawn(self._download(album, download, args))))
+        album['deadline'] = time.monotonic() + self.window
+        return True
+    
+    async def _download(self, album, download, args):
+        async with album['semaphore']:
+            return await download(*args)
+    
+    async def _finish_when_quiet(self, media_group_id):
+        album = self.albums[media_group_id]
+        while (delay := album['deadline'] - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+        # Later items with this media_group_id no longer match, so they're treated as new uploads
+        del self.albums[media_group_id]
+        
+        items = sorted(album['items'], key=lambda item: item[0])
+        results = await asyncio.gather(*(task for _, _, task in items), return_exceptions=True)
+        try:
+            await self.on_complete([update for _, update, _ in items], results)
+        except Exception as e:
+            logger.error(f"Error finishing album {media_group_id}: {e}")
+    
+    async def close(self):
+        """Cancel albums still being collected"""
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+class PendingAlbumFilter(filters.MessageFilter):
+    """Matches later items of an album that's still being collected"""
+    
+    def __init__(self, collector):
+        super().__init__(name='PendingAlbumFilter')
+        self.collector = collector
+    
+    def filter(self, message):
+        return message.media_group_id is not None and message.media_group_id in self.collector
+
+NicheStrategy = namedtuple('NicheStrategy', ['captions', 'youtube_captions', 'hashtags', 'values'])
+
+def compile_template(text):
+    """Pre-parse a caption template into (literal, field) pairs, or plain text if it has no fields"""
+    parts = tuple((literal, field) for literal, field, _, _ in string.Formatter().parse(text))
+    if all(field is None for _, field in parts):
+        return ''.join(literal for literal, _ in parts)
+    return parts
+
+def render_template(template, values):
+    """Fill a pre-parsed template"""
+    if isinstance(template, str):
+        return template
+    return ''.join(literal + (values[field] if field else '') for literal, field in template)
+
+class StrategyEngine:
+    """Caption templates and hashtag sets for every niche, loaded once from a data file"""
+    
+    def __init__(self, path=STRATEGIES_PATH, hot_reload=STRATEGY_HOT_RELOAD):
+        self.path = path
+        self.hot_reload = hot_reload
+        self.mtime = None
+        self.tables = MappingProxyType({})
+        self.load()
+    
+    def load(self):
+        """Parse the data file into immutable per-niche tables"""
+        mtime = os.stat(self.path).st_mtime
+        with open(self.path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        
+        self.tables = MappingProxyType({
+            niche: NicheStrategy(
+                captions=tuple(compile_template(text) for text in strategy['captions']),
+                youtube_captions=tuple(compile_template(text) for text in strategy['youtube_captions']),
+                hashtags=strategy['hashtags'],
+                values=MappingProxyType({'topic': strategy['topic']})
+            )
+            for niche, strategy in data.items()
+        })
+        self.mtime = mtime
+    
+    def _reload_if_changed(self):
+        """Reload the data file if hot reload is on and it changed on disk"""
+        if not self.hot_reload:
+            return
+        try:
+            if os.stat(self.path).st_mtime != self.mtime:
+                self.load()
+                logger.info(f"Reloaded niche strategies from {self.path}")
+        except Exception as e:
+            logger.error(f"Error reloading niche strategies: {e}")
+    
+    def generate(self, niche, source='upload'):
+        """Return a (caption, hashtags) pair for one item"""
+        return self.generate_batch([(niche, source)])[0]
+    
+    def generate_batch(self, items):
+        """Return (caption, hashtags) pairs for an iterable of (niche, source) items"""
+        self._reload_if_changed()
+        tables = self.tables
+        default = tables['default']
+        choice = random.choice
+        
+        results = []
+        for niche, source in items:
+            strategy = tables.get(niche, default)
+            templates = strategy.youtube_captions if source == 'youtube' else strategy.captions
+            results.append((render_template(choice(templates), strategy.values), strategy.hashtags))
+        return results
+
+class HashtagRanker:
+    """Inverted index from niche/keyword to hashtags, scored on engagement with NumPy"""
+    
+    def __init__(self, path=HASHTAG_INDEX_PATH, niches=('default', *NICHES), prior_weight=5.0,
+                 shortlist_size=256, seed=None):
+        self.path = path
+        self.niche_ids = {niche: i for i, niche in enumerate(niches)}
+        self.prior_weight = prior_weight
+        self.shortlist_size = shortlist_size
+        self.rng = np.random.default_rng(seed)
+        self.tags = []
+        self.tag_ids = {}
+        self.keyword_index = {}
+        self.keyword_arrays = {}
+        self.shortlists = {}
+        self.candidates = {}
+        self.total_impressions = 0.0
+        self.total_engagement = 0.0
+        self.impressions = np.zeros(0)
+        self.engagement = np.zeros(0)
+        self.niche_members = np.zeros((len(niches), 0), dtype=bool)
+        self.niche_impressions = np.zeros((len(niches), 0))
+        self.niche_engagement = np.zeros((len(niches), 0))
+        self.load()
+    
+    def _grow(self, size):
+        """Resize the stat arrays to hold at least size tags, doubling capacity"""
+        capacity = len(self.impressions)
+        if size <= capacity:
+            return
+        pad = max(size, capacity * 2, 1024) - capacity
+        self.impressions = np.pad(self.impressions, (0, pad))
+        self.engagement = np.pad(self.engagement, (0, pad))
+        self.niche_members = np.pad(self.niche_members, ((0, 0), (0, pad)))
+        self.niche_impressions = np.pad(self.niche_impressions, ((0, 0), (0, pad)))
+        self.niche_engagement = np.pad(self.niche_engagement, ((0, 0), (0, pad)))
+    
+    def _tag_ids(self, tags):
+        """Map tag strings to a unique ID array, adding unseen tags to the vocabulary"""
+        ids = set()
+        for tag in tags:
+            tag = tag.lstrip('#').lower()
+            tag_id = self.tag_ids.get(tag)
+            if tag_id is None:
+                tag_id = self.tag_ids[tag] = len(self.tags)
+                self.tags.append(tag)
+            ids.add(tag_id)
+        self._grow(len(self.tags))
+        return np.fromiter(ids, dtype=np.int64, count=len(ids))
+    
+    def _expected(self, row, ids):
+        """Expected engagement of tags in a niche, shrunk towards their global and overall averages"""
+        weight = self.prior_weight
+        prior = self.total_engagement / self.total_impressions if self.total_impressions else 0.0
+        overall = (self.engagement[ids] + prior * weight) / (self.impressions[ids] + weight)
+        return (self.niche_engagement[row, ids] + overall * weight) / (self.niche_impressions[row, ids] + weight)
+    
+    def _trim(self, row, ids):
+        """Keep the shortlist_size best tags by expected engagement, sorted by ID"""
+        if len(ids) > self.shortlist_size:
+            ids = ids[np.argpartition(-self._expected(row, ids), self.shortlist_size - 1)[:self.shortlist_size]]
+        return np.sort(ids)
+    
+    def _merge(self, row, ids, new_ids):
+        """Add tags to a sorted candidate array, trimming it once it doubles"""
+        merged = np.union1d(ids, new_ids)
+        return merged if len(merged) <= 2 * self.shortlist_size else self._trim(row, merged)
+    
+    def _shortlist(self, row):
+        """Return the niche's best candidates, rebuilding them from the full index if needed"""
+        shortlist = self.shortlists.get(row)
+        if shortlist is None:
+            shortlist = self.shortlists[row] = self._trim(row, np.flatnonzero(self.niche_members[row]))
+        return shortlist
+    
+    def _candidates(self, row):
+        """The niche's shortlist joined with the general reach tags, which compete with it for every post"""
+        candidates = self.candidates.get(row)
+        if candidates is None:
+            candidates = self._shortlist(row)
+            if row:
+                candidates = np.union1d(candidates, self._shortlist(0))
+            self.candidates[row] = candidates
+        return candidates
+    
+    def _invalidate(self, row):
+        """Drop the merged candidates that include a niche's shortlist"""
+        if row:
+            self.candidates.pop(row, None)
+        else:
+            self.candidates.clear()
+    
+    def warm(self):
+        """Build every niche's candidates now rather than on its first post"""
+        for row in range(len(self.niche_ids)):
+            self._candidates(row)
+    
+    def seed(self, niche, tags):
+        """Register a niche's starter hashtags as candidates"""
+        ids = self._tag_ids(tags)
+        row = self.niche_ids.get(niche, 0)
+        self.niche_members[row, ids] = True
+        self.shortlists.pop(row, None)
+        self._invalidate(row)
+    
+    def record_result(self, niche, tags, engagement, keywords=()):
+        """Fold one post's engagement rate into the stats of every tag it used"""
+        ids = self._tag_ids(tags)
+        row = self.niche_ids.get(niche, 0)
+        self.impressions[ids] += 1
+        self.engagement[ids] += engagement
+        self.niche_members[row, ids] = True
+        self.niche_impressions[row, ids] += 1
+        self.niche_engagement[row, ids] += engagement
+        self.total_impressions += len(ids)
+        self.total_engagement += engagement * len(ids)
+        
+        # Only the touched tags can have moved up, so merge them into the cached candidates instead of rescanning
+        if row in self.shortlists:
+            self.shortlists[row] = self._merge(row, self.shortlists[row], ids)
+            self._invalidate(row)
+        
+        for keyword in keywords:
+            entry = self.keyword_index.setdefault(keyword, set())
+            entry.update(ids.tolist())
+            for cached_row in range(len(self.niche_ids)):
+                array = self.keyword_arrays.get((cached_row, keyword))
+                if array is not None:
+                    self.keyword_arrays[(cached_row, keyword)] = self._merge(cached_row, array, ids)
+    
+    def rank(self, niche, keywords=(), k=10):
+        """Pick the top-k hashtags for a post, sampling to keep exploring little-used tags"""
+        row = self.niche_ids.get(niche, 0)
+        parts = [self._candidates(row)]
+        for keyword in keywords:
+            if keyword in self.keyword_index:
+                # Trimmed by this niche's scores, so cached per niche
+                array = self.keyword_arrays.get((row, keyword))
+                if array is None:
+                    array = self.keyword_arrays[(row, keyword)] = self._trim(
+                        row, np.fromiter(self.keyword_index[keyword], dtype=np.int64)
+                    )
+                parts.append(array)
+        candidates = parts[0]
+        if len(parts) > 1:
+            # Sorting and dropping repeats is several times faster than np.unique on arrays this small
+            candidates = np.sort(np.concatenate(parts))
+            candidates = candidates[np.concatenate(([True], candidates[1:] != candidates[:-1]))]
+        if not len(candidates):
+            return []
+        
+        # Thompson-style noise that shrinks as a tag gathers evidence in this niche
+        scores = self._expected(row, candidates)
+        prior = self.total_engagement / self.total_impressions if self.total_impressions else 0.0
+        spread = max(prior, 0.01) / 2
+        counts = self.niche_impressions[row, candidates]
+        scores += self.rng.standard_normal(len(candidates)) * spread / np.sqrt(counts + self.prior_weight)
+        
+        k = min(k, len(candidates))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [self.tags[i] for i in candidates[top]]
+    
+    def save(self):
+        """Write the vocabulary, stats and keyword index to an .npz snapshot"""
+        size = len(self.tags)
+        keywords = list(self.keyword_index)
+        lengths = [len(self.keyword_index[keyword]) for keyword in keywords]
+        tmp_path = f"{self.path}.tmp.npz"
+        np.savez(
+            tmp_path,
+            tags=np.array(self.tags, dtype=str),
+            niches=np.array(list(self.niche_ids), dtype=str),
+            impressions=self.impressions[:size],
+            engagement=self.engagement[:size],
+            niche_members=self.niche_members[:, :size],
+            niche_impressions=self.niche_impressions[:, :size],
+            niche_engagement=self.niche_engagement[:, :size],
+            keywords=np.array(keywords, dtype=str),
+            keyword_offsets=np.cumsum([0] + lengths),
+            keyword_values=np.array([i for keyword in keywords for i in self.keyword_index[keyword]], dtype=np.int64)
+        )
+        os.replace(tmp_path, self.path)
+    
+    def load(self):
+        """Restore a snapshot written by save()"""
+        if not os.path.exists(self.path):
+            return
+        
+        try:
+            with np.load(self.path) as snapshot:
+                self.tags = snapshot['tags'].tolist()
+                self.tag_ids = {tag: i for i, tag in enumerate(self.tags)}
+                self.impressions = snapshot['impressions'].copy()
+                self.engagement = snapshot['engagement'].copy()
+                self.total_impressions = float(self.impressions.sum())
+                self.total_engagement = float(self.engagement.sum())
+                
+                # Snapshot niches may be ordered differently from ours
+                size = len(self.tags)
+                self.niche_members = np.zeros((len(self.niche_ids), size), dtype=bool)
+                self.niche_impressions = np.zeros((len(self.niche_ids), size))
+                self.niche_engagement = np.zeros((len(self.niche_ids), size))
+                for i, niche in enumerate(snapshot['niches'].tolist()):
+                    row = self.niche_ids.get(niche)
+                    if row is not None:
+                        self.niche_members[row] = snapshot['niche_members'][i]
+                        self.niche_impressions[row] = snapshot['niche_impressions'][i]
+                        self.niche_engagement[row] = snapshot['niche_engagement'][i]
+                
+                offsets = snapshot['keyword_offsets']
+                values = snapshot['keyword_values']
+                self.keyword_index = {
+                    keyword: set(values[offsets[i]:offsets[i + 1]].tolist())
+                    for i, keyword in enumerate(snapshot['keywords'].tolist())
+                }
+                self.keyword_arrays = {}
+                self.shortlists = {}
+                self.candidates = {}
+        except Exception as e:
+            logger.error(f"Error loading hashtag index: {e}")
+
+@functools.lru_cache(maxsize=None)
+def chunk_masks(radius):
+    """XOR masks for every value within `radius` bits of a 16-bit chunk"""
+    return tuple(
+        sum(1 << bit for bit in bits)
+        for distance in range(radius + 1)
+        for bits in itertools.combinations(range(16), distance)
+    )
 
-# Niche options with emojis
-NICHES = {
-    'fitness': '💪 Fitness & Health',
-    'tech': '📱 Technology & Gadgets',
-    'business': '💼 Business & Entrepreneurship',
-    'travel': '✈️ Travel & Adventure',
-    'food': '🍔 Food & Cooking',
-    'fashion': '👗 Fashion & Beauty',
-    'motivation': '🔥 Motivation & Self-Improvement',
-    'education': '🎓 Education & Learning',
-    'entertainment': '🎬 Entertainment & Movies',
-    'gaming': '🎮 Gaming & Esports'
-}
+def popcount(values):
+    """Set bits in each uint64"""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    return np.unpackbits(values.view(np.uint8)).reshape(-1, 64).sum(axis=1)
+
+class AccountHashIndex:
+    """Multi-index hashing over one account's 64-bit hashes, with one table per 16-bit chunk
+    
+    Two hashes within distance d agree to within d // 4 bits on at least one chunk, so a lookup
+    only probes that small neighbourhood of each chunk and then checks the candidates exactly.
+    """
+    
+    def __init__(self, capacity=64):
+        self.hashes = np.zeros(capacity, dtype=np.uint64)
+        self.items = np.zeros(capacity, dtype=np.int64)
+        self.times = np.zeros(capacity)
+        self.size = 0
+        self.tables = [{} for _ in range(4)]
+    
+    def add(self, value, item, timestamp):
+        if self.size == len(self.hashes):
+            capacity = 2 * len(self.hashes)
+            self.hashes = np.resize(self.hashes, capacity)
+            self.items = np.resize(self.items, capacity)
+            self.times = np.resize(self.times, capacity)
+        
+        row = self.size
+        self.hashes[row], self.items[row], self.times[row] = value, item, timestamp
+        for i, table in enumerate(self.tables):
+            table.setdefault((value >> (16 * i)) & 0xFFFF, []).append(row)
+        self.size += 1
+    
+    def prune(self, since):
+        """Drop hashes added before `since`, once at least a quarter of the rows have aged out"""
+        # Rows are appended in time order, so the expired ones are a prefix
+        expired = int(np.searchsorted(self.times[:self.size], since))
+        if not expired or expired * 4 < self.size:
+            return
+        hashes, items, times = (column[expired:self.size].copy() for column in (self.hashes, self.items, self.times))
+        self.__init__(max(64, len(hashes)))
+        for value, item, timestamp in zip(hashes.tolist(), items.tolist(), times.tolist()):
+            self.add(value, item, timestamp)
+    
+    def search(self, value, max_distance, since):
+        """Return the items (and when they were added) of hashes within max_distance added since `since`"""
+        masks = chunk_masks(max_distance // 4)
+        rows = set()
+        for i, table in enumerate(self.tables):
+            chunk = (value >> (16 * i)) & 0xFFFF
+            for mask in masks:
+                bucket = table.get(chunk ^ mask)
+                if bucket:
+                    rows.update(bucket)
+        if not rows:
+            return [], []
+        
+        rows = np.fromiter(rows, dtype=np.int64, count=len(rows))
+        keep = (popcount(self.hashes[rows] ^ np.uint64(value)) <= max_distance) & (self.times[rows] >= since)
+        rows = rows[keep]
+        return self.items[rows].tolist(), self.times[rows].tolist()
+
+class DuplicateIndex:
+    """Near-duplicate lookups over the perceptual hashes of everything each account has queued
+    
+    Adds are appended to a log as they happen and the .npz snapshot is rewritten in a background
+    thread every compact_every adds, so a crash loses nothing that was added before it.
+    """
+    
+    def __init__(self, path=DUPLICATE_INDEX_PATH, max_distance=DUPLICATE_MAX_DISTANCE,
+                 window_days=DUPLICATE_WINDOW_DAYS, compact_every=DUPLICATE_COMPACT_EVERY):
+        self.path = path
+        self.log_path = f"{os.path.splitext(path)[0]}.log"
+        self.max_distance = max_distance
+        self.window = window_days * 86400
+        self.compact_every = compact_every
+        self.accounts = {}
+        self.next_item = 0
+        self.logged = 0
+        self.compacting = False
+        self.compactor = None
+        self.saves = itertools.count()
+        self.lock = threading.Lock()
+        # Held for a whole save, so a compaction and close() never rotate the log or write a snapshot at once
+        self.save_lock = threading.Lock()
+        self.load()
+        self.log = open(self.log_path, 'a')
+    
+    def find(self, account, hashes, now=None):
+        """Return when a near-duplicate of this photo or video was queued within the window, or None
+        
+        A video matches an earlier one when at least half of its sampled keyframes do.
+        """
+        index = self.accounts.get(account)
+        if index is None or not hashes:
+            return None
+        
+        since = (now or time.time()) - self.window
+        matches = Counter()
+        added = {}
+        for value in hashes:
+            items, times = index.search(value, self.max_distance, since)
+            added.update(zip(items, times))
+            matches.update(set(items))
+        
+        needed = (len(hashes) + 1) // 2
+        found = [added[item] for item, count in matches.items() if count >= needed]
+        return max(found) if found else None
+    
+    def add(self, account, hashes, timestamp=None):
+        """Record one queued photo or video"""
+        if not hashes:
+            return
+        timestamp = timestamp or time.time()
+        with self.lock:
+            index = self.accounts.get(account)
+            if index is None:
+                index = self.accounts[account] = AccountHashIndex()
+            index.prune(timestamp - self.window)
+            for value in hashes:
+                index.add(value, self.next_item, timestamp)
+            self.log.write(json.dumps([account, self.next_item, timestamp, list(hashes)]) + '\n')
+            self.log.flush()
+            self.next_item += 1
+            self.logged += 1
+            compact = self.logged >= self.compact_every and not self.compacting
+            self.compacting = self.compacting or compact
+        if compact:
+            self.compactor = threading.Thread(target=self.save, name='DuplicateIndexCompaction')
+            self.compactor.start()
+    
+    def save(self):
+        """Write every hash still inside the window to an .npz snapshot and start a new log"""
+        with self.save_lock:
+            try:
+                self._save()
+            finally:
+                self.compacting = False
+    
+    def _save(self):
+        rotated_path = f"{self.log_path}.1"
+        with self.lock:
+            since = time.time() - self.window
+            # Accounts with nothing inside the window are dropped from memory too
+            for account in [name for name, index in self.accounts.items() if index.times[index.size - 1] < since]:
+                del self.accounts[account]
+            
+            names = list(self.accounts)
+            columns = {'accounts': [], 'hashes': [], 'items': [], 'times': []}
+            for account_id, index in enumerate(self.accounts.values()):
+                live = np.flatnonzero(index.times[:index.size] >= since)
+                columns['accounts'].append(np.full(len(live), account_id, dtype=np.int64))
+                columns['hashes'].append(index.hashes[live])
+                columns['items'].append(index.items[live])
+                columns['times'].append(index.times[live])
+            next_item = self.next_item
+            
+            # Set the log aside until the snapshot covering it is in place; a log left over from
+            # an interrupted save isn't covered by any snapshot yet, so it's kept by appending
+            self.log.close()
+            if os.path.exists(rotated_path):
+                with open(self.log_path) as src, open(rotated_path, 'a') as dst:
+                    dst.write(src.read())
+                os.remove(self.log_path)
+            else:
+                os.replace(self.log_path, rotated_path)
+            self.log = open(self.log_path, 'a')
+            self.logged = 0
+        
+        empty = {'accounts': np.int64, 'hashes': np.uint64, 'items': np.int64, 'times': np.float64}
+        tmp_path = f"{self.path}.{os.getpid()}.{next(self.saves)}.tmp.npz"
+        np.savez(
+            tmp_path,
+            names=np.array(names, dtype=str),
+            next_item=next_item,
+            **{name: np.concatenate(parts) if parts else np.zeros(0, dtype=empty[name])
+               for name, parts in columns.items()}
+        )
+        os.replace(tmp_path, self.path)
+        os.remove(rotated_path)
+    
+    def load(self):
+        """Restore the snapshot written by save() and replay the adds logged since, dropping aged-out hashes"""
+        since = time.time() - self.window
+        if os.path.exists(self.path):
+            try:
+                with np.load(self.path) as snapshot:
+                    names = snapshot['names'].tolist()
+                    live = snapshot['times'] >= since
+                    for account_id, value, item, timestamp in zip(
+                        snapshot['accounts'][live].tolist(), snapshot['hashes'][live].tolist(),
+                        snapshot['items'][live].tolist(), snapshot['times'][live].tolist()
+                    ):
+                        index = self.accounts.get(names[account_id])
+                        if index is None:
+                            index = self.accounts[names[account_id]] = AccountHashIndex()
+                        index.add(value, item, timestamp)
+                    self.next_item = int(snapshot['next_item'])
+            except Exception as e:
+                logger.error(f"Error loading duplicate index: {e}")
+        
+        for log_path in (f"{self.log_path}.1", self.log_path):
+            if not os.path.exists(log_path):
+                continue
+            with open(log_path) as f:
+                for line in f:
+                    try:
+                        account, item, timestamp, hashes = json.loads(line)
+                    except ValueError:
+                        # The last line may be cut short by a crash
+                        continue
+                    self.next_item = max(self.next_item, item + 1)
+                    self.logged += 1
+                    if timestamp < since:
+                        continue
+                    index = self.accounts.get(account)
+                    if index is None:
+                        index = self.accounts[account] = AccountHashIndex()
+                    for value in hashes:
+                        index.add(value, item, timestamp)
+    
+    def close(self):
+        """Wait for a running compaction, write a final snapshot and close the log"""
+        if self.compactor is not None:
+            self.compactor.join()
+        self.save()
+        self.log.close()
+
+def hour_of_week(timestamps, utc_offset):
+    """Map Unix timestamps to local hour-of-week slots (Monday 00:00 is slot 0)"""
+    hours = (np.asarray(timestamps, dtype=np.float64) + utc_offset) // 3600
+    # 1970-01-01 was a Thursday
+    return (((hours // 24 + 3) % 7) * 24 + hours % 24).astype(np.int64)
+
+class AnalyticsStore:
+    """Append-only columnar post metrics with per-user hour-of-week rollups"""
+    
+    COLUMNS = {'user_id': np.int64, 'posted_at': np.float64, 'views': np.float64, 'engagement': np.float64}
+    
+    def __init__(self, root=ANALYTICS_DIR):
+        self.root = root
+        self.utc_offset = time.localtime().tm_gmtoff
+        self.buffer = {name: [] for name in self.COLUMNS}
+        self.buffer_lock = threading.Lock()
+        self.rollups = {}
+        self.events = 0
+        os.makedirs(root, exist_ok=True)
+        self._load()
+    
+    def _column_path(self, name):
+        """Path of a raw column file"""
+        return os.path.join(self.root, f"{name}.bin")
+    
+    def _column(self, name, start=0):
+        """Memory-map a column from the given row onwards"""
+        dtype = np.dtype(self.COLUMNS[name])
+        path = self._column_path(name)
+        if not os.path.exists(path) or os.path.getsize(path) <= start * dtype.itemsize:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r', offset=start * dtype.itemsize)
+    
+    def _load(self):
+        """Restore the rollup snapshot and fold in any events written after it"""
+        snapshot_path = os.path.join(self.root, 'rollups.npz')
+        if os.path.exists(snapshot_path):
+            with np.load(snapshot_path) as snapshot:
+                self.events = int(snapshot['events'])
+                for user_id, rollup in zip(snapshot['user_ids'].tolist(), snapshot['rollups']):
+                    self.rollups[user_id] = rollup.copy()
+        
+        # All columns are flushed together, so the shortest one is the committed length
+        rows = min(len(self._column(name, self.events)) for name in self.COLUMNS)
+        if rows:
+            tail = {name: np.asarray(self._column(name, self.events)[:rows]) for name in self.COLUMNS}
+            self._fold(tail['user_id'], tail['posted_at'], tail['views'], tail['engagement'])
+            logger.info(f"Folded {rows} analytics events into rollups")
+    
+    def _fold(self, user_ids, posted_at, views, engagement):
+        """Add events to the rollups, summing each user's events in one vectorized pass"""
+        slots = hour_of_week(posted_at, self.utc_offset)
+        users, rows = np.unique(user_ids, return_inverse=True)
+        sums = np.zeros((len(users), 3, 168))
+        np.add.at(sums, (rows, 0, slots), 1)
+        np.add.at(sums, (rows, 1, slots), views)
+        np.add.at(sums, (rows, 2, slots), engagement)
+        for user_id, rollup in zip(users.tolist(), sums):
+            if user_id in self.rollups:
+                self.rollups[user_id] += rollup
+            else:
+                self.rollups[user_id] = rollup
+        self.events += len(user_ids)
+    
+    def record(self, user_id, posted_at, views, engagement):
+        """Record one post's metrics; rollups update immediately, columns are appended by flush()"""
+        user_id = int(user_id)
+        slot = int(hour_of_week(posted_at, self.utc_offset))
+        rollup = self.rollups.setdefault(user_id, np.zeros((3, 168)))
+        rollup[0, slot] += 1
+        rollup[1, slot] += views
+        rollup[2, slot] += engagement
+        
+        with self.buffer_lock:
+            for name, value in zip(self.COLUMNS, (user_id, posted_at, views, engagement)):
+                self.buffer[name].append(value)
+    
+    def flush(self):
+        """Append buffered events to the column files (safe to run in a thread while record() is called)"""
+        with self.buffer_lock:
+            buffer, self.buffer = self.buffer, {name: [] for name in self.COLUMNS}
+        if not buffer['user_id']:
+            return
+        for name, dtype in self.COLUMNS.items():
+            with open(self._column_path(name), 'ab') as f:
+                f.write(np.asarray(buffer[name], dtype=dtype).tobytes())
+        self.events += len(buffer['user_id'])
+    
+    def close(self):
+        """Flush, then snapshot the rollups so the next start doesn't replay the columns"""
+        # The snapshot covers every user, so it's only written here; after a crash, _load
+        # folds the events appended since the last snapshot back in instead
+        self.flush()
+        if self.rollups:
+            tmp_path = os.path.join(self.root, 'rollups.tmp.npz')
+            np.savez(
+                tmp_path,
+                events=self.events,
+                user_ids=np.fromiter(self.rollups, dtype=np.int64),
+                rollups=np.stack(list(self.rollups.values()))
+            )
+            os.replace(tmp_path, os.path.join(self.root, 'rollups.npz'))
+    
+    def summary(self, user_id):
+        """Post count, averages and best posting slots for a user, or None without data"""
+        rollup = self.rollups.get(int(user_id))
+        if rollup is None or not rollup[0].any():
+            return None
+        
+        posts = rollup[0].sum()
+        by_hour = rollup.reshape(3, 7, 24).sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slot_rate = np.where(rollup[0] > 0, rollup[2] / rollup[0], -1)
+            hour_rate = np.where(by_hour[0] > 0, by_hour[2] / by_hour[0], -1)
+        
+        return {
+            'posts': int(posts),
+            'avg_views': float(rollup[1].sum() / posts),
+            'avg_engagement': float(rollup[2].sum() / posts),
+            'best_hour': int(hour_rate.argmax()),
+            'best_day': int(slot_rate.argmax()) // 24
+        }
+    
+    def best_hour(self, user_id, default=DEFAULT_POST_HOUR):
+        """Hour of day with the highest average engagement for the user"""
+        summary = self.summary(user_id)
+        return summary['best_hour'] if summary else default
+
+OutboundMessage = namedtuple('OutboundMessage', ['priority', 'text', 'reply_markup', 'futures'])
+
+class TokenBucket:
+    """Token bucket refilled continuously at rate tokens per second"""
+    
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+    
+    def delay(self, now):
+        """Seconds until a token is available"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        refill = (1 - self.tokens) / self.rate if self.tokens < 1 else 0
+        return max(refill, self.blocked_until - now, 0)
+    
+    def take(self):
+        """Spend one token"""
+        self.tokens -= 1
+
+class MessageSender:
+    """Delivers outbound messages under per-chat and global rate limits, interactive replies first"""
+    
+    def __init__(self, bot=None, global_rate=GLOBAL_MESSAGES_PER_SECOND, chat_rate=CHAT_MESSAGES_PER_SECOND,
+                 chat_burst=CHAT_MESSAGE_BURST, merge=MERGE_REPLIES):
+        self.bot = bot
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.merge = merge
+        self.queues = {}
+        self.buckets = {}
+        self.ready = []
+        self.delayed = []
+        self.sequence = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.tasks = set()
+        self.runner = None
+    
+    def send(self, chat_id, text, reply_markup=None, priority=PRIORITY_INTERACTIVE):
+        """Queue a message; the returned future resolves to the sent Message, or None if sending failed"""
+        future = asyncio.get_running_loop().create_future()
+        message = OutboundMessage(priority, text, reply_markup, [future])
+        queue = self.queues.get(chat_id)
+        if queue is None:
+            # A chat is in the ready or delayed heap (or sending) exactly while it has a queue
+            queue = self.queues[chat_id] = []
+            heapq.heappush(queue, (priority, next(self.sequence), message))
+            self._schedule(chat_id)
+        else:
+            # Each chat's queue is a heap too, so a reply isn't held up by that user's job notifications
+            heapq.heappush(queue, (priority, next(self.sequence), message))
+        return future
+    
+    def _schedule(self, chat_id):
+        """Make a chat eligible to send its next message"""
+        heapq.heappush(self.ready, (self.queues[chat_id][0][0], next(self.sequence), chat_id))
+        self.wakeup.set()
+    
+    def _next_message(self, chat_id):
+        """Pop the chat's most urgent message, merging later texts of the same priority into it
+        
+        Returns its queue position too, so a message that has to be retried goes back where it was.
+        """
+        queue = self.queues[chat_id]
+        _, sequence, message = heapq.heappop(queue)
+        while (self.merge and queue and queue[0][0] == message.priority
+               and len(message.text) + len(queue[0][2].text) + 2 <= MAX_MESSAGE_LENGTH):
+            _, _, following = heapq.heappop(queue)
+            # The later keyboard replaces the earlier one, so keeping the last markup is what the user sees anyway
+            message = OutboundMessage(
+                message.priority,
+                f"{message.text}\n\n{following.text}",
+                following.reply_markup if following.reply_markup is not None else message.reply_markup,
+                message.futures + following.futures
+            )
+        return sequence, message
+    
+    async def run(self):
+        """Send queued messages as fast as the buckets allow"""
+        while True:
+            self.wakeup.clear()
+            now = time.monotonic()
+            while self.delayed and self.delayed[0][0] <= now:
+                _, _, chat_id = heapq.heappop(self.delayed)
+                self._schedule(chat_id)
+            
+            if not self.ready:
+                timeout = self.delayed[0][0] - now if self.delayed else None
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            wait = self.global_bucket.delay(now)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            
+            _, _, chat_id = heapq.heappop(self.ready)
+            bucket = self.buckets.get(chat_id)
+            if bucket is None:
+                bucket = self.buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            wait = bucket.delay(now)
+            if wait > 0:
+                heapq.heappush(self.delayed, (now + wait, next(self.sequence), chat_id))
+                continue
+            
+            bucket.take()
+            self.global_bucket.take()
+            task = asyncio.create_task(self._deliver(chat_id, *self._next_message(chat_id)))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+    
+    async def _deliver(self, chat_id, sequence, message):
+        """Send one message, requeueing it if Telegram asks us to back off"""
+        try:
+            sent = await self.bot.send_message(chat_id, message.text, reply_markup=message.reply_markup)
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+            logger.warning(f"Flood limit for chat {chat_id}, retrying in {retry_after}s")
+            heapq.heappush(self.queues[chat_id], (message.priority, sequence, message))
+            self.buckets[chat_id].blocked_until = time.monotonic() + retry_after
+        except Exception as e:
+            logger.error(f"Error sending message to {chat_id}: {e}")
+            for future in message.futures:
+                future.set_result(None)
+        else:
+            for future in message.futures:
+                future.set_result(sent)
+        finally:
+            if self.queues[chat_id]:
+                self._schedule(chat_id)
+            else:
+                del self.queues[chat_id]
+                if len(self.buckets) > 4096:
+                    self._prune_buckets()
+    
+    def _prune_buckets(self):
+        """Forget idle chats whose buckets have refilled; a fresh bucket behaves the same"""
+        now = time.monotonic()
+        for chat_id in [chat_id for chat_id in self.buckets if chat_id not in self.queues]:
+            bucket = self.buckets[chat_id]
+            if not bucket.delay(now) and bucket.tokens >= bucket.burst:
+                del self.buckets[chat_id]
+    
+    def start(self, bot):
+        """Start delivering with the given bot"""
+        self.bot = bot
+        self.runner = asyncio.create_task(self.run())
+    
+    async def close(self, timeout=5.0):
+        """Give queued messages a chance to go out, then stop"""
+        deadline = time.monotonic() + timeout
+        while (self.queues or self.tasks) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self.runner:
+            self.runner.cancel()
+            await asyncio.gather(self.runner, return_exceptions=True)
+
+class Histogram:
+    """Latency histogram with Prometheus-style upper-bound buckets"""
+    
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+def format_labels(labels, extra=()):
+    """Render label pairs as {key="value",...}, or nothing when there are none"""
+    pairs = [*labels, *extra]
+    if not pairs:
+        return ''
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in pairs) + '}'
+
+def wrap_handlers(application, wrap):
+    """Replace every handler callback on the application, including conversation states, with wrap(name, callback)"""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if isinstance(handler, ConversationHandler):
+                nested = [*handler.entry_points, *itertools.chain(*handler.states.values()), *handler.fallbacks]
+            else:
+                nested = [handler]
+            for inner in nested:
+                inner.callback = wrap(inner.callback.__name__, inner.callback)
+
+class Metrics:
+    """In-process counters, gauges and histograms, rendered in the Prometheus text format"""
+    
+    def __init__(self):
+        self.descriptions = {}
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        # The loop watchdog thread increments counters too
+        self.lock = threading.Lock()
+    
+    def describe(self, name, kind, help_text):
+        self.descriptions[name] = (kind, help_text)
+    
+    def inc(self, name, labels=(), amount=1):
+        with self.lock:
+            self.counters[(name, labels)] = self.counters.get((name, labels), 0) + amount
+    
+    def observe(self, name, labels, value):
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.histograms[(name, labels)] = Histogram()
+        histogram.observe(value)
+    
+    def gauge(self, name, help_text, read):
+        """Register a gauge whose value is read when the metrics are scraped"""
+        self.describe(name, 'gauge', help_text)
+        self.gauges[name] = read
+    
+    def instrument_handler(self, name, callback):
+        """Wrap a handler callback to record its latency and count the exceptions it raises"""
+        labels = (('handler', name),)
+        
+        @functools.wraps(callback)
+        async def timed(update, context):
+            started = time.perf_counter()
+            try:
+                return await callback(update, context)
+            except Exception:
+                self.inc('telegram_handler_errors_total', labels)
+                raise
+            finally:
+                self.observe('telegram_handler_duration_seconds', labels, time.perf_counter() - started)
+        return timed
+    
+    def instrument(self, application):
+        """Wrap every handler registered on the application, including those inside conversation states"""
+        self.describe('telegram_handler_duration_seconds', 'histogram', 'Time spent in each handler callback')
+        self.describe('telegram_handler_errors_total', 'counter', 'Exceptions raised by each handler callback')
+        wrap_handlers(application, self.instrument_handler)
+    
+    def instrument_function(self, metric, function):
+        """Wrap a synchronous function to record its latency in a histogram labelled with its name"""
+        labels = (('function', function.__name__),)
+        
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.observe(metric, labels, time.perf_counter() - started)
+        return timed
+    
+    def render(self):
+        """Return every metric in the Prometheus text exposition format"""
+        with self.lock:
+            counters = dict(self.counters)
+        series = {}
+        for (name, labels), value in counters.items():
+            series.setdefault(name, []).append(f"{name}{format_labels(labels)} {value}")
+        for (name, labels), histogram in list(self.histograms.items()):
+            lines = series.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip((*histogram.buckets, '+Inf'), histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+        for name, read in self.gauges.items():
+            try:
+                series[name] = [f"{name} {read()}"]
+            except Exception as e:
+                logger.error(f"Error reading gauge {name}: {e}")
+        
+        out = []
+        for name, lines in series.items():
+            kind, help_text = self.descriptions.get(name, ('untyped', ''))
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(lines)
+        return '\n'.join(out) + '\n'
+
+class LoopMonitor:
+    """Samples event-loop lag and logs the stack that's running whenever the loop stays blocked"""
+    
+    def __init__(self, metrics, interval=LOOP_LAG_INTERVAL, threshold=LOOP_BLOCK_THRESHOLD):
+        self.metrics = metrics
+        self.interval = interval
+        self.threshold = threshold
+        self.heartbeat = time.monotonic()
+        self.loop_thread = None
+        self.task = None
+        self.watchdog = None
+        self.stopped = threading.Event()
+        metrics.describe('event_loop_lag_seconds', 'histogram', 'How late the event loop woke up for a timer')
+        metrics.describe('event_loop_blocked_total', 'counter', f'Times a callback blocked the loop over {threshold}s')
+    
+    async def run(self):
+        """Sleep for one interval at a time and record how late each wakeup was"""
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            self.heartbeat = time.monotonic()
+            self.metrics.observe('event_loop_lag_seconds', (), max(0.0, self.heartbeat - expected))
+    
+    def _watch(self):
+        """Runs in a thread; reports once per stall, while the blocking code is still on the stack"""
+        reported = None
+        while not self.stopped.wait(self.threshold / 2):
+            heartbeat = self.heartbeat
+            if heartbeat == reported or time.monotonic() - heartbeat < self.interval + self.threshold:
+                continue
+            reported = heartbeat
+            frame = sys._current_frames().get(self.loop_thread)
+            stack = ''.join(traceback.format_stack(frame, limit=8)) if frame else '  (no frame)\n'
+            self.metrics.inc('event_loop_blocked_total')
+            logger.warning(f"Event loop blocked for over {self.threshold}s in:\n{stack.rstrip()}")
+    
+    def start(self):
+        """Start sampling the running loop"""
+        self.loop_thread = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.task = asyncio.create_task(self.run())
+        self.watchdog = threading.Thread(target=self._watch, name='LoopWatchdog', daemon=True)
+        self.watchdog.start()
+    
+    async def stop(self):
+        """Stop the sampler and the watchdog thread"""
+        self.stopped.set()
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        if self.watchdog:
+            self.watchdog.join()
+
+def sample_stacks(thread_id, seconds, interval=0.005):
+    """Sample a thread's Python stack; return a Counter of folded stacks ("outer;inner") for flame graphs"""
+    stacks = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        names = []
+        while frame is not None:
+            names.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)})")
+            frame = frame.f_back
+        if names:
+            stacks[';'.join(reversed(names))] += 1
+        time.sleep(interval)
+    return stacks
+
+class MetricsServer:
+    """Local HTTP endpoint serving /metrics and on-demand /profile?seconds=N stack samples"""
+    
+    def __init__(self, metrics, host=METRICS_LISTEN, port=METRICS_PORT):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self.server = None
+        self.loop_thread = None
+        self.profiling = False
+    
+    async def start(self):
+        self.loop_thread = threading.get_ident()
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+    
+    async def _handle(self, reader, writer):
+        """Answer a single GET and close the connection"""
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            while await asyncio.wait_for(reader.readline(), 5) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            url = urllib.parse.urlsplit(parts[1] if len(parts) > 1 else '/')
+            status, body = await self._route(url)
+            data = body.encode()
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode() + data
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+    
+    async def _route(self, url):
+        if url.path == '/metrics':
+            return '200 OK', self.metrics.render()
+        if url.path != '/profile':
+            return '404 Not Found', 'Try /metrics or /profile?seconds=10\n'
+        
+        try:
+            seconds = float(urllib.parse.parse_qs(url.query).get('seconds', ['10'])[0])
+        except ValueError:
+            return '400 Bad Request', 'seconds must be a number\n'
+        if self.profiling:
+            return '409 Conflict', 'A profile is already running\n'
+        
+        # Sample from a thread so the loop being profiled keeps running normally
+        self.profiling = True
+        try:
+            stacks = await asyncio.to_thread(
+                sample_stacks, self.loop_thread, min(max(seconds, 0.1), PROFILE_MAX_SECONDS)
+            )
+        finally:
+            self.profiling = False
+        return '200 OK', ''.join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+    
+    async def close(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates concurrently while keeping each user's updates in arrival order"""
+    
+    def __init__(self, max_concurrent_updates=CONCURRENT_UPDATES):
+        # process_update holds the base class semaphore while an update waits for its user's lock, so one busy
+        # user would use up the slots; leave that one effectively unbounded and apply the limit after the lock
+        super().__init__(2 ** 31 - 1)
+        self.running = asyncio.Semaphore(max_concurrent_updates)
+        self.locks = {}
+    
+    async def do_process_update(self, update, coroutine):
+        """Run the update once every earlier update from the same user has finished"""
+        key = None
+        if isinstance(update, Update):
+            user = update.effective_user or update.effective_chat
+            key = user.id if user else None
+        if key is None:
+            async with self.running:
+                await coroutine
+            return
+        
+        # Each entry is [lock, number of updates holding or waiting for it]
+        entry = self.locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0], self.running:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[key]
+    
+    async def initialize(self):
+        """Nothing to set up"""
+    
+    async def shutdown(self):
+        """In-flight updates are drained by Application.stop before this is called"""
+        self.locks.clear()
 
 class TelegramSocialBot:
-    def __init__(self, token):
+    def __init__(self, token, user_store=None, request=None, shard=None):
         self.token = token
-        self.application = Application.builder().token(token).build()
+        # shard is (index, count) when this process handles one hash range of users for a ShardRouter
+        self.shard = shard
+        shards = shard[1] if shard else 1
+        builder = (
+            Application.builder()
+            .token(token)
+            .base_url(TELEGRAM_API_URL)
+            .base_file_url(TELEGRAM_FILE_URL)
+            .persistence(SQLitePersistence(shard=shard))
+            .concurrent_updates(PerUserUpdateProcessor())
+            .post_init(self.post_init)
+            .post_shutdown(self.shutdown)
+        )
+        # A custom BaseRequest (e.g. an offline fake for benchmarks) replaces the HTTP client for Bot API calls
+        if request is not None:
+            builder = builder.request(request)
+        self.application = builder.build()
         self.user_data = {}
+        self.user_store = user_store or SQLiteUserStore(shard=shard)
+        self.video_jobs = VideoJobPool(output_dir=per_shard_path(REELS_DIR, shard))
+        self.upload_jobs = BackgroundJobs(MAX_PENDING_UPLOAD_JOBS, MAX_UPLOAD_JOBS_PER_USER)
+        self.ffmpeg = FfmpegGovernor()
+        self.transcodes = TranscodeCache(per_shard_path(TRANSCODE_DIR, shard), governor=self.ffmpeg)
+        self.youtube = YouTubeResolver()
+        self.reels_in_flight = InFlight()
+        # Shards share the bot's global send limit
+        self.sender = MessageSender(global_rate=GLOBAL_MESSAGES_PER_SECOND / shards)
+        self.analytics_store = AnalyticsStore(per_shard_path(ANALYTICS_DIR, shard))
+        self.scheduler = UploadScheduler(publish=self.publish_upload, shard=shard)
+        self.scheduler.best_hour = self.analytics_store.best_hour
+        self.media_cache = MediaCache(governor=self.ffmpeg, shard=shard)
+        self.albums = AlbumCollector(self.finish_album)
+        self.duplicates = DuplicateIndex(per_shard_path(DUPLICATE_INDEX_PATH, shard))
+        # MEDIA_PUBLIC_URL serves the directory holding the cache, so shards' downloads.shardN directories resolve too
+        self.publisher = InstagramPublisher()
+        self.strategies = StrategyEngine()
+        self.hashtags = HashtagRanker(per_shard_path(HASHTAG_INDEX_PATH, shard))
+        for niche, strategy in self.strategies.tables.items():
+            self.hashtags.seed(niche, strategy.hashtags.split())
+        self.hashtags.warm()
+        self.scheduler_task = None
+        self.insights_task = None
+        self.metrics = Metrics()
+        self.loop_monitor = LoopMonitor(self.metrics)
+        self.metrics_server = None
+        if METRICS_PORT:
+            self.metrics_server = MetricsServer(self.metrics, port=METRICS_PORT + (shard[0] if shard else 0))
         self.load_user_data()
         
         # Add conversation handler with niche selection
@@ -58,7 +2835,7 @@ class TelegramSocialBot:
             entry_points=[CommandHandler('start', self.start)],
             states={
                 NICHE_SELECTION: [
-                    MessageHandler(filters.Regex(f'^({"|".join(NICHES.keys())})$'), self.niche_selected),
+                    MessageHandler(filters.Regex(f'^({"|".join(map(re.escape, NICHES.values()))})$'), self.niche_selected),
                     MessageHandler(filters.TEXT & ~filters.COMMAND, self.invalid_niche)
                 ],
                 MAIN_MENU: [
@@ -68,6 +2845,8 @@ class TelegramSocialBot:
                     MessageHandler(filters.Regex('^📊 Analytics$'), self.analytics),
                     MessageHandler(filters.Regex('^🔍 AI Optimization$'), self.ai_optimization),
                     MessageHandler(filters.Regex('^◀️ Back$'), self.start),
+                    # The first album item moves the user to the main menu; the rest still belong to the upload
+                    MessageHandler(PendingAlbumFilter(self.albums), self.handle_upload),
                 ],
                 UPLOAD_CONTENT: [
                     MessageHandler(filters.PHOTO | filters.VIDEO | filters.Document.ALL, self.handle_upload),
@@ -79,28 +2858,138 @@ class TelegramSocialBot:
                 ]
             },
             fallbacks=[CommandHandler('cancel', self.cancel)],
+            name='main_conversation',
+            persistent=True,
         )
         
         self.application.add_handler(conv_handler)
         self.application.add_handler(CommandHandler("help", self.help_command))
         
+        self.metrics.instrument(self.application)
+        self.metrics.describe('ai_generation_duration_seconds', 'histogram',
+                              'Time spent generating captions and hashtags')
+        self.ai_optimize_content = self.metrics.instrument_function(
+            'ai_generation_duration_seconds', self.ai_optimize_content)
+        self.ai_generate_youtube_content = self.metrics.instrument_function(
+            'ai_generation_duration_seconds', self.ai_generate_youtube_content)
+        self.metrics.gauge('telegram_update_queue_depth', 'Updates received but not yet dispatched',
+                           lambda: self.application.update_queue.qsize())
+        self.metrics.gauge('telegram_updates_in_flight', 'Updates being handled or waiting on the same user',
+                           lambda: self.application.update_processor.current_concurrent_updates)
+        self.metrics.gauge('media_downloads_in_flight', 'Uploads being downloaded or preprocessed',
+                           lambda: self.media_cache.downloads)
+        self.metrics.gauge('video_jobs_running', 'YouTube jobs running or waiting for a worker',
+                           lambda: len(self.video_jobs.tasks))
+        self.metrics.gauge('upload_jobs_running', 'Single uploads being downloaded, preprocessed or queued',
+                           lambda: len(self.upload_jobs.tasks))
+        self.metrics.gauge('ffmpeg_processes_running', 'ffmpeg processes holding a governor slot',
+                           lambda: self.ffmpeg.running)
+        self.metrics.gauge('outbound_messages_queued', 'Messages waiting for the rate-limited sender',
+                           lambda: sum(map(len, self.sender.queues.values())))
+        self.metrics.gauge('uploads_queued', 'Items waiting in the upload scheduler',
+                           lambda: len(self.scheduler.heap))
+        self.metrics.gauge('user_store_pending_writes', 'User records waiting for the next batched write',
+                           lambda: len(getattr(self.user_store, 'pending', ())))
+        
     def load_user_data(self):
-        """Load user data from file"""
+        """Load user data from the user store"""
         try:
-            if os.path.exists('user_data.json'):
-                with open('user_data.json', 'r') as f:
-                    self.user_data = json.load(f)
+            self.user_data = self.user_store.load()
         except Exception as e:
             logger.error(f"Error loading user data: {e}")
     
-    def save_user_data(self):
-        """Save user data to file"""
+    def save_user_data(self, user_id):
+        """Queue a single user's data for the next batched write"""
         try:
-            with open('user_data.json', 'w') as f:
-                json.dump(self.user_data, f)
+            self.user_store.update(user_id, self.user_data[user_id])
         except Exception as e:
             logger.error(f"Error saving user data: {e}")
     
+    async def post_init(self, application):
+        """Start the upload scheduler, message sender and metrics once the application is initialized"""
+        self.scheduler_task = asyncio.create_task(self.scheduler.run())
+        self.insights_task = asyncio.create_task(self.collect_insights())
+        self.sender.start(application.bot)
+        self.loop_monitor.start()
+        if self.metrics_server:
+            await self.metrics_server.start()
+    
+    async def shutdown(self, application):
+        """Stop background jobs and flush pending writes when the application stops"""
+        if self.metrics_server:
+            await self.metrics_server.close()
+        await self.loop_monitor.stop()
+        for task in (self.scheduler_task, self.insights_task):
+            if task:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        await self.scheduler.drain()
+        await self.albums.close()
+        await self.upload_jobs.shutdown()
+        await self.sender.close()
+        self.scheduler.close()
+        self.publisher.close()
+        self.media_cache.close()
+        self.transcodes.close()
+        await asyncio.to_thread(self.hashtags.save)
+        await asyncio.to_thread(self.duplicates.close)
+        await asyncio.to_thread(self.analytics_store.close)
+        await self.video_jobs.shutdown()
+        await asyncio.to_thread(self.user_store.close)
+    
+    async def publish_upload(self, account, chat_id, payload):
+        """Publish a queued item to the account's Instagram and tell the user how it went"""
+        try:
+            media_id = await self.publisher.publish(account, payload)
+        except Exception:
+            if chat_id is not None:
+                await self.notify(chat_id, f"❌ I couldn't post your scheduled {payload['type']} to Instagram.")
+            raise
+        else:
+            logger.info(f"Published {payload['type']} for {account} as {media_id}")
+            if chat_id is not None:
+                await self.notify(chat_id, f"📣 Your scheduled {payload['type']} is now live on Instagram!")
+            return media_id
+        finally:
+            for path in payload['media']:
+                self.media_cache.release(path)
+    
+    async def collect_insights(self):
+        """Fetch metrics for posts once they've settled and feed them into analytics and hashtag ranking"""
+        while True:
+            now = time.time()
+            rows = self.scheduler.unmeasured(now - INSIGHTS_DELAY_HOURS * 3600)
+            results = await asyncio.gather(
+                *(self.publisher.insights(account, media_id) for _, account, _, media_id, _ in rows),
+                return_exceptions=True
+            )
+            for (upload_id, account, posted_at, media_id, payload), result in zip(rows, results):
+                if isinstance(result, Exception):
+                    logger.warning(f"Couldn't fetch insights for {media_id}: {result}")
+                    # Retry on the next round unless the post was deleted or its metrics are gone for good
+                    if posted_at > now - INSIGHTS_GIVE_UP_DAYS * 86400:
+                        continue
+                else:
+                    views, engagement = result
+                    self.record_post_result(
+                        account, payload.get('niche', 'default'), payload['caption'], payload['hashtags'],
+                        posted_at, views, engagement
+                    )
+                self.scheduler.mark_measured(upload_id)
+            
+            if rows:
+                await asyncio.to_thread(self.analytics_store.flush)
+                await asyncio.to_thread(self.hashtags.save)
+            await asyncio.sleep(INSIGHTS_POLL_SECONDS)
+    
+    async def reply(self, update, text, reply_markup=None):
+        """Queue an interactive reply to the update's chat"""
+        self.sender.send(update.effective_chat.id, text, reply_markup)
+    
+    async def notify(self, chat_id, text):
+        """Queue a background notification"""
+        self.sender.send(chat_id, text, priority=PRIORITY_BACKGROUND)
+    
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """Start command - niche selection"""
         user_id = str(update.effective_user.id)
@@ -122,7 +3011,8 @@ class TelegramSocialBot:
         
         reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
         
-        await update.message.reply_text(
+        await self.reply(
+            update,
             "👋 Welcome to Social Media Automation Bot!\n\n"
             "To provide you with the best content strategy, please select your niche:",
             reply_markup=reply_markup
@@ -143,7 +3033,7 @@ class TelegramSocialBot:
                 break
         
         if not niche:
-            await update.message.reply_text("Invalid niche selection. Please try again.")
+            await self.reply(update, "Invalid niche selection. Please try again.")
             return NICHE_SELECTION
         
         # Save user niche
@@ -151,9 +3041,10 @@ class TelegramSocialBot:
             self.user_data[user_id] = {}
         
         self.user_data[user_id]['niche'] = niche
-        self.save_user_data()
+        self.save_user_data(user_id)
         
-        await update.message.reply_text(
+        await self.reply(
+            update,
             f"Great! You've selected the {niche_text} niche.\n\n"
             f"I'll now optimize content specifically for this niche to maximize your engagement and growth potential.",
             reply_markup=ReplyKeyboardRemove()
@@ -163,7 +3054,8 @@ class TelegramSocialBot:
     
     async def invalid_niche(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """Handle invalid niche selection"""
-        await update.message.reply_text(
+        await self.reply(
+            update,
             "Please select a valid niche from the options provided."
         )
         return NICHE_SELECTION
@@ -182,7 +3074,8 @@ class TelegramSocialBot:
         
         reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
         
-        await update.message.reply_text(
+        await self.reply(
+            update,
             f"🏠 Main Menu - {niche_name}\n\n"
             "What would you like to do today?",
             reply_markup=reply_markup
@@ -195,7 +3088,8 @@ class TelegramSocialBot:
         keyboard = [['◀️ Back']]
         reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
         
-        await update.message.reply_text(
+        await self.reply(
+            update,
             "📤 Upload Content\n\n"
             "Please send me a photo or video to post on Instagram. "
             "I'll automatically optimize it for your niche and schedule it for the best time.",
@@ -209,7 +3103,8 @@ class TelegramSocialBot:
         keyboard = [['◀️ Back']]
         reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
         
-        await update.message.reply_text(
+        await self.reply(
+            update,
             "🎥 YouTube to Reel\n\n"
             "Send me a YouTube link and I'll:\n"
             "1. Download the video\n"
@@ -223,28 +3118,74 @@ class TelegramSocialBot:
         
         return YOUTUBE_PROCESSING
     
+    def upload_media(self, message):
+        """Return (media, file_type, kind, ext) for a message's attachment, or None if it has none we support"""
+        if message.photo:
+            return message.photo[-1], "photo", "photo", "jpg"
+        if message.video:
+            return message.video, "video", "video", "mp4"
+        if message.document:
+            media = message.document
+            kind = (media.mime_type or '').split('/')[0]
+            if kind == 'image':
+                kind = 'photo'
+            ext = os.path.splitext(media.file_name or '')[1].lstrip('.').lower() or "bin"
+            return media, "document", kind, ext
+        return None
+    
     async def handle_upload(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """Handle file uploads"""
         user_id = str(update.effective_user.id)
         
         # Get the file
-        if update.message.photo:
-            file = await update.message.photo[-1].get_file()
-            file_type = "photo"
-        elif update.message.video:
-            file = await update.message.video.get_file()
-            file_type = "video"
-        elif update.message.document:
-            file = await update.message.document.get_file()
-            file_type = "document"
-        else:
-            await update.message.reply_text("Unsupported file type. Please send a photo or video.")
+        attachment = self.upload_media(update.message)
+        if attachment is None:
+            await self.reply(update, "Unsupported file type. Please send a photo or video.")
             return UPLOAD_CONTENT
+        media, file_type, kind, ext = attachment
+        
+        # Album items are downloaded as they arrive and posted together as one carousel
+        if update.message.media_group_id:
+            if not self.albums.add(update.message.media_group_id, update, self.media_cache.fetch, media, kind, ext):
+                await self.reply(update, f"Carousels hold up to {MAX_CAROUSEL_ITEMS} items, so I skipped the rest.")
+            return MAIN_MENU
+        
+        # Downloading and preprocessing (a full transcode for video) runs after the reply, so it
+        # doesn't hold one of the update slots other users' menu taps are waiting for
+        job_id = self.upload_jobs.submit(
+            user_id, self.process_upload_job, user_id, update.effective_chat.id, media, file_type, kind, ext
+        )
+        if job_id is None:
+            await self.reply(
+                update,
+                "⏳ I'm still preparing your other uploads. Please send this one again once they're queued."
+            )
+            return await self.main_menu(update, context)
+        
+        await self.reply(update, f"📥 Got your {file_type}! I'm preparing it and will message you once it's queued.")
+        return await self.main_menu(update, context)
+    
+    async def process_upload_job(self, job_id, user_id, chat_id, media, file_type, kind, ext):
+        """Download, preprocess and queue a single upload, then tell the user how it went"""
+        try:
+            # Download and preprocess the file, reusing the cached copy of anything sent before
+            file_name = await self.media_cache.fetch(media, kind, ext)
+        except Exception as e:
+            logger.error(f"Error processing upload job {job_id}: {e}")
+            await self.notify(chat_id, "❌ Sorry, I couldn't process that file. Please try sending it again.")
+            return
         
-        # Download the file
-        file_name = f"downloads/{user_id}_{int(time.time())}.{file_type}"
-        os.makedirs('downloads', exist_ok=True)
-        await file.download_to_drive(file_name)
+        # Posting the same thing twice hurts reach, so skip anything this account queued recently
+        hashes = await self.media_hashes(file_name, kind)
+        duplicate_of = self.duplicates.find(user_id, hashes)
+        if duplicate_of is not None:
+            self.media_cache.release(file_name)
+            await self.notify(
+                chat_id,
+                f"🔁 This looks like something you already queued on {datetime.fromtimestamp(duplicate_of):%b %d}, "
+                "so I skipped it. Posting the same content twice hurts your reach."
+            )
+            return
         
         # Get user niche for optimization
         niche = self.user_data[user_id].get('niche', 'general')
@@ -252,15 +3193,99 @@ class TelegramSocialBot:
         # Generate AI-optimized caption and hashtags
         caption, hashtags = self.ai_optimize_content(file_name, niche, file_type)
         
-        # Add to upload queue (in a real implementation, this would connect to the Instagram bot)
-        await update.message.reply_text(
+        # Add to upload queue
+        scheduled_at = self.scheduler.add(user_id, chat_id, {
+            'type': file_type, 'media': [file_name], 'caption': caption, 'hashtags': hashtags, 'niche': niche
+        })
+        if scheduled_at is None:
+            self.media_cache.release(file_name)
+            await self.notify(
+                chat_id, "⏳ Your upload queue is full. Please wait for some posts to go out before adding more."
+            )
+            return
+        self.duplicates.add(user_id, hashes)
+        
+        await self.notify(
+            chat_id,
             f"✅ Content received and optimized!\n\n"
             f"📝 Caption: {caption}\n\n"
             f"🏷️ Hashtags: {hashtags}\n\n"
-            f"I've added this to the upload queue and will post it at the optimal time for maximum engagement."
+            f"I've added this to the upload queue and will post it at the optimal time for maximum engagement "
+            f"({scheduled_at:%b %d, %I:%M %p})."
         )
+    
+    async def media_hashes(self, path, kind):
+        """Perceptual hashes of a processed file; a hashing failure never blocks an upload"""
+        try:
+            loop = asyncio.get_running_loop()
+            async with self.ffmpeg.slots(1 if kind == 'video' else 0):
+                return await loop.run_in_executor(self.media_cache.executor, perceptual_hashes, path, kind)
+        except Exception as e:
+            logger.warning(f"Couldn't hash {path}: {e}")
+            return []
+    
+    async def finish_album(self, updates, results):
+        """Queue a collected album as one carousel post and send a single summary"""
+        update = updates[-1]
+        user_id = str(update.effective_user.id)
+        items = []
+        for item_update, result in zip(updates, results):
+            if isinstance(result, BaseException):
+                logger.error(f"Error downloading album item for {user_id}: {result}")
+            else:
+                items.append((result, self.upload_media(item_update.message)[2]))
         
-        return await self.main_menu(update, context)
+        # Leave out items this account queued recently
+        hashes = await asyncio.gather(*(self.media_hashes(path, kind) for path, kind in items))
+        kept = []
+        for (path, _), item_hashes in zip(items, hashes):
+            if self.duplicates.find(user_id, item_hashes) is None:
+                kept.append((path, item_hashes))
+            else:
+                self.media_cache.release(path)
+        failed, duplicates = len(results) - len(items), len(items) - len(kept)
+        
+        if not kept:
+            if duplicates:
+                await self.reply(update, "🔁 You've already queued everything in that album recently, so I skipped it.")
+            else:
+                await self.reply(update, "❌ I couldn't download that album. Please try sending it again.")
+            await self.main_menu(update, None)
+            return
+        
+        paths = [path for path, _ in kept]
+        niche = self.user_data[user_id].get('niche', 'general')
+        caption, hashtags = self.ai_optimize_content(paths[0], niche, 'carousel')
+        scheduled_at = self.scheduler.add(user_id, update.effective_chat.id, {
+            'type': 'carousel', 'media': paths, 'caption': caption, 'hashtags': hashtags, 'niche': niche
+        })
+        if scheduled_at is None:
+            for path in paths:
+                self.media_cache.release(path)
+            await self.reply(
+                update,
+                "⏳ Your upload queue is full. Please wait for some posts to go out before adding more."
+            )
+            await self.main_menu(update, None)
+            return
+        for _, item_hashes in kept:
+            self.duplicates.add(user_id, item_hashes)
+        
+        notes = []
+        if failed:
+            notes.append(f"{failed} failed to download")
+        if duplicates:
+            notes.append(f"{duplicates} already queued recently")
+        note = f" (left out {len(results) - len(paths)}: {', '.join(notes)})" if notes else ""
+        await self.reply(
+            update,
+            f"✅ Album of {len(paths)} items received and optimized as a carousel{note}!\n\n"
+            f"📝 Caption: {caption}\n\n"
+            f"🏷️ Hashtags: {hashtags}\n\n"
+            f"I've added this to the upload queue and will post it at the optimal time for maximum engagement "
+            f"({scheduled_at:%b %d, %I:%M %p})."
+        )
+        await self.main_menu(update, None)
     
     async def handle_youtube_link(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """Handle YouTube link processing"""
@@ -268,8 +3293,10 @@ class TelegramSocialBot:
         youtube_url = update.message.text
         
         # Validate YouTube URL
-        if not self.is_valid_youtube_url(youtube_url):
-            await update.message.reply_text(
+        video_id = self.youtube.video_id(youtube_url)
+        if video_id is None:
+            await self.reply(
+                update,
                 "That doesn't look like a valid YouTube URL. Please try again."
             )
             return YOUTUBE_PROCESSING
@@ -277,26 +3304,114 @@ class TelegramSocialBot:
         # Get user niche for optimization
         niche = self.user_data[user_id].get('niche', 'general')
         
-        # Process the YouTube video (in a real implementation)
-        await update.message.reply_text(
+        # Hand the video off to the worker pool and reply right away
+        job_id = self.video_jobs.submit(
+            user_id, self.process_youtube_job, user_id, update.effective_chat.id, video_id, niche
+        )
+        if job_id is None:
+            await self.reply(
+                update,
+                "⏳ I'm already working on your other videos. Please try again once they're done."
+            )
+            return await self.main_menu(update, context)
+        
+        await self.reply(
+            update,
             "🔍 Analyzing YouTube video...\n\n"
-            "I'm finding the most engaging segment and optimizing it for Instagram Reels."
+            "I'm finding the most engaging segment and optimizing it for Instagram Reels. "
+            "I'll message you when it's ready."
+        )
+        
+        return await self.main_menu(update, context)
+    
+    async def build_reel(self, job_id, chat_id, video_id, metadata):
+        """Download a video, pick its best clip and transcode it through the shared transcode cache"""
+        await self.notify(chat_id, "⬇️ Downloading video...")
+        source_path, subtitles_path = await self.video_jobs.run(
+            download_youtube_video, job_id, youtube_watch_url(video_id), self.video_jobs.output_dir,
+            metadata.get('captions', True)
         )
         
-        # Simulate processing time
-        time.sleep(2)
+        try:
+            await self.notify(chat_id, "🔍 Finding the most engaging clip...")
+            try:
+                # Clip detection decodes audio and video with two ffmpeg processes side by side
+                async with self.ffmpeg.slots(2):
+                    start, end = await self.video_jobs.run(find_best_clip, source_path)
+            except Exception as e:
+                logger.warning(f"Clip detection failed for job {job_id}, using the opening clip: {e}")
+                start, end = 0, CLIP_MAX_SECONDS
+            
+            await self.notify(chat_id, "🎬 Converting to vertical Reel format...")
+            return await self.transcodes.transcode(video_id, start, end, source_path, subtitles_path)
+        finally:
+            for path in (source_path, subtitles_path):
+                if path and os.path.exists(path):
+                    os.remove(path)
+    
+    async def process_youtube_job(self, job_id, user_id, chat_id, video_id, niche):
+        """Turn a YouTube video into a queued Reel, reporting progress to the chat"""
+        youtube_url = youtube_watch_url(video_id)
+        
+        reel_path = self.transcodes.lookup(video_id)
+        if reel_path:
+            await self.notify(chat_id, "♻️ This video was converted recently, reusing that Reel...")
+        
+        try:
+            if not reel_path:
+                try:
+                    metadata = await self.youtube.metadata(video_id)
+                except Exception as e:
+                    logger.warning(f"Couldn't fetch metadata for {video_id}: {e}")
+                    metadata = {}
+                
+                if (metadata.get('duration') or 0) > YOUTUBE_MAX_DURATION:
+                    await self.notify(chat_id, "❌ That video is too long to process. Please send a shorter one.")
+                    return
+                
+                # The same link sent by several users at once is downloaded and cut once
+                joining = video_id in self.reels_in_flight
+                build = self.reels_in_flight.run(video_id, lambda: self.build_reel(job_id, chat_id, video_id, metadata))
+                if joining:
+                    await self.notify(chat_id, "♻️ This video is already being converted, I'll use that Reel...")
+                reel_path = await build
+        except Exception as e:
+            logger.error(f"Error processing YouTube job {job_id}: {e}")
+            await self.notify(chat_id, "❌ Sorry, I couldn't process that video. Please try another link.")
+            return
+        
+        logger.info(f"YouTube job {job_id} finished: {reel_path}")
+        
+        hashes = await self.media_hashes(reel_path, 'video')
+        duplicate_of = self.duplicates.find(user_id, hashes)
+        if duplicate_of is not None:
+            await self.notify(
+                chat_id, f"🔁 You already queued this Reel on {datetime.fromtimestamp(duplicate_of):%b %d}, "
+                "so I didn't add it again."
+            )
+            return
         
         # Generate AI-optimized content
         caption, hashtags = self.ai_generate_youtube_content(youtube_url, niche)
         
-        await update.message.reply_text(
+        scheduled_at = self.scheduler.add(user_id, chat_id, {
+            'type': 'reel', 'media': [reel_path], 'caption': caption, 'hashtags': hashtags, 'niche': niche
+        })
+        if scheduled_at is None:
+            await self.notify(
+                chat_id, "⏳ Your Reel is ready, but your upload queue is full. Please try again later."
+            )
+            return
+        self.duplicates.add(user_id, hashes)
+        
+        await self.notify(
+            chat_id,
             f"✅ YouTube video processed!\n\n"
             f"📝 Caption: {caption}\n\n"
             f"🏷️ Hashtags: {hashtags}\n\n"
-            f"I've added this to the upload queue and will post it at the optimal time for maximum engagement."
+            f"I've added this to the upload queue and will post it at the optimal time for maximum engagement "
+            f"({scheduled_at:%b %d, %I:%M %p})."
         )
-        
-        return await self.main_menu(update, context)
     
     async def settings(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """Show settings menu"""
@@ -312,7 +3427,8 @@ class TelegramSocialBot:
         
         reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
         
-        await update.message.reply_text(
+        await self.reply(
+            update,
             f"⚙️ Settings - Current Niche: {niche_name}\n\n"
             "Configure your automation preferences:",
             reply_markup=reply_markup
@@ -322,18 +3438,39 @@ class TelegramSocialBot:
     
     async def analytics(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """Show analytics"""
-        # In a real implementation, this would show actual analytics data
+        user_id = str(update.effective_user.id)
+        
         keyboard = [['◀️ Back']]
         reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
         
-        await update.message.reply_text(
+        niche = self.user_data.get(user_id, {}).get('niche', 'general')
+        niche_name = NICHES.get(niche, 'General')
+        posts_today = f"📈 Posts today: {self.scheduler.posts_today(user_id)}/{self.scheduler.daily_limit}\n"
+        
+        summary = self.analytics_store.summary(user_id)
+        if summary is None:
+            await self.reply(
+                update,
+                "📊 Account Analytics\n\n"
+                + posts_today +
+                f"🔥 Top performing niche: {niche_name}\n\n"
+                "💡 Stats will appear here once your first posts are published.",
+                reply_markup=reply_markup
+            )
+            return MAIN_MENU
+        
+        best_time = datetime(2000, 1, 1, summary['best_hour']).strftime('%I:%M %p').lstrip('0')
+        best_day = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday'][summary['best_day']]
+        
+        await self.reply(
+            update,
             "📊 Account Analytics\n\n"
-            "📈 Posts today: 3/10\n"
-            "👀 Average views: 12,457\n"
-            "👍 Average engagement: 8.7%\n"
-            "🕒 Best posting time: 7:00 PM\n"
-            "🔥 Top performing niche: " + NICHES.get(self.user_data.get(str(update.effective_user.id), {}).get('niche', 'general'), 'General') + "\n\n"
-            "💡 Recommendation: Post more motivational content in the evening for higher engagement.",
+            + posts_today +
+            f"👀 Average views: {summary['avg_views']:,.0f}\n"
+            f"👍 Average engagement: {summary['avg_engagement']:.1%}\n"
+            f"🕒 Best posting time: {best_time}\n"
+            f"🔥 Top performing niche: {niche_name}\n\n"
+            f"💡 Recommendation: Post more {niche_name} content on {best_day}s around {best_time} for higher engagement.",
             reply_markup=reply_markup
         )
         
@@ -349,7 +3486,8 @@ class TelegramSocialBot:
         
         reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
         
-        await update.message.reply_text(
+        await self.reply(
+            update,
             "🔍 AI Optimization Tools\n\n"
             "Leverage AI to improve your content strategy and growth:",
             reply_markup=reply_markup
@@ -359,7 +3497,8 @@ class TelegramSocialBot:
     
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Send a help message"""
-        await update.message.reply_text(
+        await self.reply(
+            update,
             "🤖 Social Media Automation Bot Help\n\n"
             "I can help you automate your Instagram content strategy:\n\n"
             "/start - Begin setup and niche selection\n"
@@ -375,7 +3514,8 @@ class TelegramSocialBot:
     
     async def cancel(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """Cancel the conversation"""
-        await update.message.reply_text(
+        await self.reply(
+            update,
             "Operation cancelled.",
             reply_markup=ReplyKeyboardRemove()
         )
@@ -383,106 +3523,106 @@ class TelegramSocialBot:
     
     def is_valid_youtube_url(self, url):
         """Check if the URL is a valid YouTube URL"""
-        youtube_regex = (
-            r'(https?://)?(www\.)?'
-            r'(youtube|youtu|youtube-nocookie)\.(com|be)/'
-            r'(watch\?v=|embed/|v/|.+\?v=)?([^&=%\?]{11})')
-        
-        return re.match(youtube_regex, url) is not None
+        return self.youtube.video_id(url) is not None
     
     def ai_optimize_content(self, file_path, niche, content_type):
         """AI optimization for content (simulated)"""
         # In a real implementation, this would use ML models or API calls
-        
-        # Niche-specific content strategies
-        niche_strategies = {
-            'fitness': {
-                'captions': [
-                    "Transform your body in 30 days! 💪 #FitnessJourney\n\nWho's joining me? 👇",
-                    "Form is everything! Proper technique prevents injury and maximizes results. 🏋️‍♂️\n\nSave this for your next workout!",
-                    "The only bad workout is the one that didn't happen. Get after it! 🔥"
-                ],
-                'hashtags': '#fitness #workout #gym #health #fit #motivation #training #lifestyle #fitfam #gymlife'
-            },
-            'tech': {
-                'captions': [
-                    "This new tech is going to change everything! 🤯\n\nWhat do you think? 👇",
-                    "Tech tip of the day: Always keep your software updated for security and performance! 🔒\n\nSave this tip!",
-                    "The future is here, and it's amazing! This technology will revolutionize how we live. 🚀"
-                ],
-                'hashtags': '#technology #tech #gadgets #innovation #ai #future #digital #device #techie #techtips'
-            },
-            'business': {
-                'captions': [
-                    "This business strategy doubled my revenue in 30 days! 📈\n\nWant me to explain how? 👇",
-                    "Entrepreneur tip: Focus on providing value, not just making sales. The money will follow. 💼\n\nAgree?",
-                    "The most successful people invest in themselves first. Never stop learning! 📚"
-                ],
-                'hashtags': '#business #entrepreneur #success #motivation #marketing #startup #leadership #money #growth #hustle'
-            }
-        }
-        
-        # Default strategy if niche not found
-        strategy = niche_strategies.get(niche, {
-            'captions': [
-                "Check out this amazing content! 🌟\n\nWhat do you think? 👇",
-                "This is going to change your perspective! 💡\n\nSave for later! 📌",
-                "You need to see this! 🔥\n\nShare with someone who needs to see this too!"
-            ],
-            'hashtags': '#viral #trending #explorepage #fyp #foryou #instagram #content #follow #like #share'
-        })
-        
-        caption = random.choice(strategy['captions'])
-        hashtags = strategy['hashtags']
-        
-        return caption, hashtags
+        caption, hashtags = self.strategies.generate(niche, 'upload')
+        return caption, self.rank_hashtags(niche, caption, hashtags)
     
     def ai_generate_youtube_content(self, youtube_url, niche):
         """AI content generation for YouTube videos (simulated)"""
         # In a real implementation, this would analyze the YouTube video content
-        
-        # Simulate different responses based on niche
-        niche_responses = {
-            'fitness': {
-                'captions': [
-                    "This workout technique from YouTube completely transformed my routine! 💪\n\nWatch and learn! 👇",
-                    "I found this amazing fitness tutorial on YouTube that I had to share! 🏋️‍♂️\n\nSave this for your next workout!",
-                    "Game-changing fitness advice from experts on YouTube! 🔥\n\nWho's trying this with me?"
-                ]
-            },
-            'tech': {
-                'captions': [
-                    "This YouTube tech review saved me from buying the wrong product! 📱\n\nVery insightful! 👇",
-                    "Amazing tech tutorial I found on YouTube that everyone should see! 🤯\n\nSave this for later!",
-                    "This YouTube channel has the best tech tips I've ever seen! 🚀\n\nCheck it out!"
-                ]
-            },
-            'business': {
-                'captions': [
-                    "This YouTube business strategy completely changed how I approach marketing! 📈\n\nMust watch! 👇",
-                    "I found this incredible business advice on YouTube that doubled my revenue! 💼\n\nSave this!",
-                    "Game-changing entrepreneurial advice from YouTube experts! 🔥\n\nWatch and implement!"
-                ]
-            }
-        }
-        
-        # Default if niche not found
-        strategy = niche_responses.get(niche, {
-            'captions': [
-                "Amazing content I found on YouTube that you need to see! 🌟\n\nCheck it out! 👇",
-                "This YouTube video completely changed my perspective! 💡\n\nVery insightful!",
-                "You need to watch this YouTube video! 🔥\n\nShare with others who need to see this too!"
-            ]
-        })
-        
-        caption = random.choice(strategy['captions'])
-        hashtags = self.ai_optimize_content(None, niche, None)[1]  # Get hashtags from the other method
-        
-        return caption, hashtags
+        caption, hashtags = self.strategies.generate(niche, 'youtube')
+        return caption, self.rank_hashtags(niche, caption, hashtags)
+    
+    def rank_hashtags(self, niche, caption, fallback):
+        """Pick hashtags for a post from engagement history, falling back to the niche's defaults"""
+        keywords = set(re.findall(r'[a-z]{4,}', caption.lower()))
+        tags = self.hashtags.rank(niche if niche in NICHES else 'default', keywords, HASHTAGS_PER_POST)
+        return ' '.join(f"#{tag}" for tag in tags) if tags else fallback
+    
+    def record_post_result(self, user_id, niche, caption, hashtags, posted_at, views, engagement):
+        """Feed a published post's metrics into analytics and hashtag ranking"""
+        self.analytics_store.record(user_id, posted_at, views, engagement)
+        keywords = set(re.findall(r'[a-z]{4,}', caption.lower()))
+        self.hashtags.record_result(niche if niche in NICHES else 'default', hashtags.split(), engagement, keywords)
+    
+    def run(self):
+        """Run the bot, serving a webhook when WEBHOOK_URL is set and long polling otherwise"""
+        serve(self.application)
+    
+    async def serve_queue(self, updates):
+        """Handle raw update JSON from a ShardRouter's queue until it sends None"""
+        await self.application.initialize()
+        await self.post_init(self.application)
+        await self.application.start()
+        try:
+            while (data := await asyncio.to_thread(updates.get)) is not None:
+                await self.application.update_queue.put(Update.de_json(json.loads(data), self.application.bot))
+        finally:
+            await self.application.stop()
+            await self.application.shutdown()
+            await self.shutdown(self.application)
+
+def serve(application):
+    """Run an application, serving a webhook when WEBHOOK_URL is set and long polling otherwise"""
+    if WEBHOOK_URL:
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET
+        )
+    else:
+        application.run_polling()
+
+def run_shard(token, index, count, updates):
+    """Worker process entry point; the router owns Ctrl-C and tells workers to stop through the queue"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.getLogger().addHandler(log_file(f"telegram_bot.shard{index}.log"))
+    bot = TelegramSocialBot(token, shard=(index, count))
+    asyncio.run(bot.serve_queue(updates))
 
+class ShardRouter:
+    """Receives updates in one process and forwards each to the worker process that owns its user's hash range"""
+    
+    def __init__(self, token, count=SHARDS):
+        context = multiprocessing.get_context('spawn')
+        self.queues = [context.Queue() for _ in range(count)]
+        self.workers = [
+            context.Process(target=run_shard, args=(token, index, count, queue), name=f"shard-{index}")
+            for index, queue in enumerate(self.queues)
+        ]
+        self.application = (
+            Application.builder()
+            .token(token)
+            .base_url(TELEGRAM_API_URL)
+            .base_file_url(TELEGRAM_FILE_URL)
+            .post_shutdown(self.shutdown)
+            .build()
+        )
+        self.application.add_handler(TypeHandler(Update, self.route))
+    
+    async def route(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        owner = update.effective_user or update.effective_chat
+        index = shard_of(owner.id, len(self.queues)) if owner else 0
+        self.queues[index].put(update.to_json())
+    
+    async def shutdown(self, application):
+        """Let every worker drain its queue and shut down cleanly"""
+        for queue in self.queues:
+            queue.put(None)
+        for worker in self.workers:
+            await asyncio.to_thread(worker.join)
+    
     def run(self):
-        """Run the bot"""
-        self.application.run_polling()
+        for worker in self.workers:
+            worker.start()
+        logger.info(f"Started {len(self.workers)} shard workers")
+        serve(self.application)
 
 # Main execution
 if __name__ == "__main__":
@@ -493,5 +3633,8 @@ if __name__ == "__main__":
         print("Please set the TELEGRAM_BOT_TOKEN environment variable")
         exit(1)
     
-    bot = TelegramSocialBot(BOT_TOKEN)
-    bot.run()
\ No newline at end of file
+    if SHARDS > 1:
+        ShardRouter(BOT_TOKEN).run()
+    else:
+        bot = TelegramSocialBot(BOT_TOKEN)
+        bot.run()
\ No newline at end of file
@@ -0,0 +1,66 @@
+"""Benchmark ClipDetector on synthetic local videos.
+
+Generates test videos with ffmpeg's lavfi sources: a quiet noise bed with
+a loud, busy segment planted at a known offset. It then times clip
+detection and reports the realtime factor, peak memory of the ffmpeg
+children, and whether the planted segment was found.
+
+    python benchmarks/bench_clip_detector.py --durations 60 600 1800
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Instagram_Auto_Adv import ClipDetector
+
+
+def make_video(path, duration, highlight_start, highlight_length=30):
+    """Render a 640x360 test video whose only loud, busy section starts at highlight_start"""
+    highlight_end = highlight_start + highlight_length
+    enable = f"between(t,{highlight_start},{highlight_end})"
+    subprocess.run(
+        ['ffmpeg', '-y', '-loglevel', 'error',
+         '-f', 'lavfi', '-i', f'color=c=gray:s=640x360:r=25:d={duration}',
+         '-f', 'lavfi', '-i', f'testsrc2=s=640x360:r=25:d={duration}',
+         '-f', 'lavfi', '-i', f'anoisesrc=a=0.005:d={duration}',
+         '-f', 'lavfi', '-i', f'sine=f=220:beep_factor=4:d={duration}',
+         '-filter_complex',
+         f"[0:v][1:v]overlay=enable='{enable}'[v];"
+         f"[3:a]volume=0:enable='not({enable})'[tone];"
+         f"[2:a][tone]amix=inputs=2:normalize=0[a]",
+         '-map', '[v]', '-map', '[a]', '-c:v', 'libx264', '-preset', 'ultrafast', '-c:a', 'aac', path],
+        check=True
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--durations', type=int, nargs='+', default=[60, 600, 1800],
+                        help='source lengths in seconds')
+    args = parser.parse_args()
+
+    detector = ClipDetector()
+    print(f"{'duration':>9} {'seconds':>8} {'realtime':>9} {'child RSS MB':>13} {'found':>12} {'planted':>12}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for duration in args.durations:
+            path = os.path.join(tmp, f"synthetic_{duration}.mp4")
+            highlight = max(0, duration * 2 // 3 - 15)
+            make_video(path, duration, highlight)
+
+            started = time.perf_counter()
+            start, end = detector.find_best_clip(path)
+            elapsed = time.perf_counter() - started
+            peak_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+            print(f"{duration:>9} {elapsed:>8.2f} {duration / elapsed:>8.0f}x {peak_mb:>13.1f} "
+                  f"{f'{start}-{end}':>12} {f'{highlight}-{highlight + 30}':>12}")
+
+
+if __name__ == '__main__':
+    main()
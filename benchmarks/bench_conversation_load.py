@@ -0,0 +1,481 @@
+"""Load-test the TelegramSocialBot conversation flow against an offline fake Bot API.
+
+Builds the bot exactly as __init__ wires it (Application, update processor,
+ConversationHandler, sender, caches) but swaps the HTTP client for a fake
+BaseRequest that answers Bot API calls in-process. Synthetic users arrive
+as a Poisson stream and walk /start -> niche -> menu -> upload, YouTube or
+browse, with exponential think times between steps. The run reports
+throughput, p50/p95/p99 latency per handler, time updates spent queued
+behind the per-user processor, and event-loop stalls. Results are written
+as JSON; pass an earlier file to --compare to flag regressions.
+
+    python benchmarks/bench_conversation_load.py --users 2000 --rate 200
+    python benchmarks/bench_conversation_load.py --mix upload=0.6,browse=0.4 --compare baseline.json
+"""
+import argparse
+import asyncio
+import io
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+import numpy as np
+from PIL import Image
+from telegram import Update
+from telegram.request import BaseRequest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+MENU_BUTTONS = {
+    'upload': '📤 Upload Content',
+    'youtube': '🎥 YouTube to Reel',
+}
+BROWSE_BUTTONS = ('⚙️ Settings', '📊 Analytics', '🔍 AI Optimization')
+SCENARIOS = ('upload', 'album', 'youtube', 'browse')
+
+
+class FakeBotRequest(BaseRequest):
+    """Answers Bot API calls in-process, with an optional simulated round-trip time"""
+
+    def __init__(self, files, latency=0.0):
+        self.files = files
+        self.latency = latency
+        self.calls = Counter()
+        self.message_ids = iter(range(1, sys.maxsize))
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        """Nothing to open"""
+
+    async def shutdown(self):
+        """Nothing to close"""
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        # File downloads go to base_file_url + token + file_path
+        if '/file/' in url:
+            self.calls['download'] += 1
+            return 200, self.files[url.rsplit('/', 1)[1].split('.')[0]]
+
+        endpoint = url.rsplit('/', 1)[1]
+        self.calls[endpoint] += 1
+        params = request_data.parameters if request_data else {}
+        if endpoint == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        elif endpoint == 'sendMessage':
+            result = {
+                'message_id': next(self.message_ids), 'date': int(time.time()),
+                'chat': {'id': params['chat_id'], 'type': 'private'}, 'text': params['text'],
+            }
+        elif endpoint == 'getFile':
+            file_id = params['file_id']
+            result = {
+                'file_id': file_id, 'file_unique_id': file_id,
+                'file_size': len(self.files[file_id]), 'file_path': f"photos/{file_id}.jpg",
+            }
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+class Recorder:
+    """Collects per-handler latencies, queueing delay and end-to-end update latency"""
+
+    def __init__(self):
+        self.enqueued = {}
+        self.latencies = defaultdict(list)
+        self.queue_waits = []
+        self.errors = Counter()
+        self.first_enqueue = None
+        self.last_done = None
+
+    def enqueue(self, update):
+        now = time.perf_counter()
+        self.enqueued[update.update_id] = now
+        if self.first_enqueue is None:
+            self.first_enqueue = now
+
+    def wrap(self, name, callback):
+        """Time a handler callback and record how long its update waited to be dispatched"""
+        async def timed(update, context):
+            started = time.perf_counter()
+            enqueued = self.enqueued.pop(update.update_id, None)
+            if enqueued is not None:
+                self.queue_waits.append(started - enqueued)
+            try:
+                return await callback(update, context)
+            except Exception:
+                self.errors[name] += 1
+                raise
+            finally:
+                self.last_done = time.perf_counter()
+                self.latencies[name].append(self.last_done - started)
+        return timed
+
+
+class LoopLagMonitor:
+    """Samples how late the event loop wakes up compared with when it was asked to"""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.lags = []
+        self.task = None
+
+    async def run(self):
+        while True:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, time.perf_counter() - expected))
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+
+
+def percentiles(samples):
+    """Summarize a list of durations in milliseconds"""
+    if not samples:
+        return {'count': 0}
+    values = np.asarray(samples) * 1000
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {
+        'count': len(values), 'mean_ms': float(values.mean()), 'p50_ms': float(p50),
+        'p95_ms': float(p95), 'p99_ms': float(p99), 'max_ms': float(values.max()),
+    }
+
+
+def parse_mix(text):
+    """Parse 'upload=0.5,youtube=0.3,browse=0.2' into normalized scenario weights"""
+    weights = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"unknown scenario {name!r}, expected one of {', '.join(SCENARIOS)}")
+        weights[name] = float(weight)
+    total = sum(weights.values())
+    if total <= 0:
+        raise argparse.ArgumentTypeError("mix weights must add up to more than zero")
+    return {name: weight / total for name, weight in weights.items()}
+
+
+def make_photos(count, seed):
+    """Render distinct JPEGs so the media cache sees a realistic mix of hits and misses"""
+    rng = np.random.default_rng(seed)
+    photos = {}
+    for i in range(count):
+        pixels = rng.integers(0, 256, (8, 6, 3), dtype=np.uint8)
+        image = Image.fromarray(pixels).resize((1200, 1600), Image.BILINEAR)
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=85)
+        photos[f"photo{i:05d}"] = buffer.getvalue()
+    return photos
+
+
+class TrafficGenerator:
+    """Builds synthetic updates for one user session at a time"""
+
+    def __init__(self, bot, niches, photo_ids, video_count, rng, album_size=5):
+        self.bot = bot
+        self.album_size = album_size
+        self.niches = niches
+        self.photo_ids = photo_ids
+        self.video_ids = [f"bench{i:06d}"[:11] for i in range(video_count)]
+        self.rng = rng
+        self.update_ids = iter(range(1, sys.maxsize))
+
+    def update(self, user_id, text=None, photo_id=None, media_group_id=None):
+        message = {
+            'message_id': next(self.update_ids), 'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}"},
+        }
+        if photo_id is not None:
+            message['photo'] = [{
+                'file_id': photo_id, 'file_unique_id': photo_id, 'width': 1200, 'height': 1600,
+            }]
+            if media_group_id is not None:
+                message['media_group_id'] = media_group_id
+        else:
+            message['text'] = text
+            if text.startswith('/'):
+                message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+        return Update.de_json({'update_id': message['message_id'], 'message': message}, self.bot)
+
+    def session(self, user_id, scenario, first):
+        """Return the updates one session sends, in order"""
+        steps = []
+        if first:
+            steps.append(self.update(user_id, '/start'))
+            steps.append(self.update(user_id, self.rng.choice(self.niches)))
+        if scenario == 'upload':
+            steps.append(self.update(user_id, MENU_BUTTONS['upload']))
+            steps.append(self.update(user_id, photo_id=self.rng.choice(self.photo_ids)))
+        elif scenario == 'album':
+            steps.append(self.update(user_id, MENU_BUTTONS['upload']))
+            group = f"album{user_id}_{len(steps)}_{self.rng.random()}"
+            for photo_id in self.rng.sample(self.photo_ids, min(self.album_size, len(self.photo_ids))):
+                steps.append(self.update(user_id, photo_id=photo_id, media_group_id=group))
+        elif scenario == 'youtube':
+            steps.append(self.update(user_id, MENU_BUTTONS['youtube']))
+            video_id = self.rng.choice(self.video_ids)
+            steps.append(self.update(user_id, f"https://www.youtube.com/watch?v={video_id}"))
+        else:
+            steps.append(self.update(user_id, self.rng.choice(BROWSE_BUTTONS)))
+        return steps
+
+
+async def wait_until(condition, timeout, interval=0.01):
+    """Poll until condition() is true or the timeout passes; return the seconds waited"""
+    started = time.perf_counter()
+    while not condition() and time.perf_counter() - started < timeout:
+        await asyncio.sleep(interval)
+    return time.perf_counter() - started
+
+
+async def run_load(args):
+    import Instagram_Auto_Adv as app_module
+
+    photos = make_photos(args.photos, args.seed)
+    fake_api = FakeBotRequest(photos, latency=args.api_latency / 1000)
+    bot = app_module.TelegramSocialBot('123456:BENCHMARK', request=fake_api)
+    application = bot.application
+
+    # YouTube jobs download over the network; stand in a job that only takes time and notifies
+    async def fake_video_job(job_id, user_id, chat_id, video_id, niche):
+        await asyncio.sleep(args.video_job_seconds)
+        await bot.notify(chat_id, f"🎬 Your Reel for {video_id} is ready (benchmark)")
+    bot.process_youtube_job = fake_video_job
+
+    recorder = Recorder()
+    app_module.wrap_handlers(application, recorder.wrap)
+    monitor = LoopLagMonitor()
+
+    rng = random.Random(args.seed)
+    traffic = TrafficGenerator(
+        application.bot, list(app_module.NICHES.values()), list(photos), args.videos, rng, args.album_size
+    )
+    scenarios, weights = zip(*args.mix.items())
+
+    await application.initialize()
+    await bot.post_init(application)
+    await application.start()
+    monitor.start()
+
+    async def user(user_id, delay):
+        await asyncio.sleep(delay)
+        for session in range(args.sessions):
+            scenario = rng.choices(scenarios, weights)[0]
+            for update in traffic.session(user_id, scenario, first=session == 0):
+                recorder.enqueue(update)
+                await application.update_queue.put(update)
+                # Telegram delivers an album's items back to back
+                if args.think_ms and not update.message.media_group_id:
+                    await asyncio.sleep(rng.expovariate(1000 / args.think_ms))
+
+    arrival = 0.0
+    users = []
+    for i in range(args.users):
+        users.append(asyncio.create_task(user(100000 + i, arrival)))
+        arrival += rng.expovariate(args.rate)
+
+    started = time.perf_counter()
+    await asyncio.gather(*users)
+    processor = application.update_processor
+    await wait_until(
+        lambda: application.update_queue.empty() and not processor.current_concurrent_updates, args.timeout
+    )
+    updates_seconds = (recorder.last_done or time.perf_counter()) - recorder.first_enqueue
+    jobs_seconds = await wait_until(
+        lambda: not bot.video_jobs.tasks and not bot.upload_jobs.tasks and not bot.albums.tasks, args.timeout
+    )
+    drain_seconds = await wait_until(lambda: not bot.sender.queues and not bot.sender.tasks, args.timeout)
+    total_seconds = time.perf_counter() - started
+
+    await monitor.stop()
+    await application.stop()
+    await application.shutdown()
+    await bot.shutdown(application)
+
+    handled = sum(len(samples) for samples in recorder.latencies.values())
+    lags = np.asarray(monitor.lags)
+    stalls = lags[lags * 1000 >= args.stall_ms]
+    return {
+        'updates': {
+            'sent': handled + len(recorder.enqueued), 'handled': handled, 'unmatched': len(recorder.enqueued),
+            'seconds': updates_seconds, 'per_second': handled / updates_seconds if updates_seconds else 0.0,
+        },
+        'handlers': {
+            name: {**percentiles(samples), 'errors': recorder.errors[name]}
+            for name, samples in sorted(recorder.latencies.items())
+        },
+        'queue_wait': percentiles(recorder.queue_waits),
+        'ai': {
+            dict(labels)['function']: {'count': histogram.count, 'mean_ms': histogram.sum / histogram.count * 1000}
+            for (name, labels), histogram in sorted(bot.metrics.histograms.items())
+            if name == 'ai_generation_duration_seconds' and histogram.count
+        },
+        'event_loop': {
+            **{key.replace('_ms', '_lag_ms'): value for key, value in percentiles(monitor.lags).items()},
+            'stalls': int(len(stalls)), 'stalled_seconds': float(stalls.sum()),
+        },
+        'background': {'jobs_seconds': jobs_seconds, 'sender_drain_seconds': drain_seconds},
+        'api_calls': dict(fake_api.calls),
+        'total_seconds': total_seconds,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', '-C', REPO_DIR, 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(results):
+    updates = results['updates']
+    print(f"updates: {updates['handled']} handled, {updates['unmatched']} unmatched "
+          f"in {updates['seconds']:.2f}s ({updates['per_second']:.0f}/s)")
+    print(f"{'handler':<22} {'count':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8} {'errors':>7}")
+    rows = [*results['handlers'].items(), ('(queue wait)', {**results['queue_wait'], 'errors': 0})]
+    for name, stats in rows:
+        if not stats['count']:
+            continue
+        print(f"{name:<22} {stats['count']:>7} {stats['p50_ms']:>8.2f} {stats['p95_ms']:>8.2f} "
+              f"{stats['p99_ms']:>8.2f} {stats['max_ms']:>8.2f} {stats['errors']:>7}")
+    for name, stats in results.get('ai', {}).items():
+        print(f"{name}: {stats['count']} calls, mean {stats['mean_ms']:.2f} ms")
+    loop = results['event_loop']
+    print(f"event loop: p99 lag {loop.get('p99_lag_ms', 0):.2f} ms, max {loop.get('max_lag_ms', 0):.2f} ms, "
+          f"{loop['stalls']} stalls totalling {loop['stalled_seconds']:.3f}s")
+    background = results['background']
+    print(f"background: video jobs, uploads and albums done {background['jobs_seconds']:.2f}s after the last update, "
+          f"sender drained {background['sender_drain_seconds']:.2f}s later")
+    print(f"api calls: {', '.join(f'{name}={count}' for name, count in sorted(results['api_calls'].items()))}")
+
+
+def compare(results, baseline, tolerance, min_delta_ms):
+    """Print current vs baseline and return the metrics that regressed by more than tolerance
+
+    Latency rows also have to move by min_delta_ms, so jitter in sub-millisecond handlers isn't flagged.
+    """
+    rows = [('throughput /s', baseline['updates']['per_second'], results['updates']['per_second'], None)]
+    for name, stats in results['handlers'].items():
+        before = baseline['handlers'].get(name)
+        if not before or not before['count'] or not stats['count']:
+            continue
+        for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+            rows.append((f"{name} {key[:-3]}", before[key], stats[key], min_delta_ms))
+    rows.append(('queue wait p99', baseline['queue_wait'].get('p99_ms', 0), results['queue_wait'].get('p99_ms', 0),
+                 min_delta_ms))
+    rows.append(('loop stalled s', baseline['event_loop']['stalled_seconds'],
+                 results['event_loop']['stalled_seconds'], min_delta_ms / 1000))
+
+    print(f"\n{'metric':<30} {'baseline':>10} {'current':>10} {'change':>8}")
+    regressions = []
+    for label, before, after, min_delta in rows:
+        change = (after - before) / before if before else 0.0
+        if min_delta is None:
+            worse = change < -tolerance
+        else:
+            worse = change > tolerance and after - before > min_delta
+        if worse:
+            regressions.append(label)
+        print(f"{label:<30} {before:>10.2f} {after:>10.2f} {change:>+8.1%}{'  REGRESSION' if worse else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000, help='number of synthetic users')
+    parser.add_argument('--rate', type=float, default=100, help='new users arriving per second')
+    parser.add_argument('--sessions', type=int, default=1, help='menu sessions per user')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('upload=0.4,youtube=0.3,browse=0.3'),
+                        help='scenario weights, e.g. upload=0.4,youtube=0.3,browse=0.3')
+    parser.add_argument('--think-ms', type=float, default=200, help='mean pause between a user\'s messages')
+    parser.add_argument('--album-size', type=int, default=5, help='photos per album in the album scenario')
+    parser.add_argument('--photos', type=int, default=50, help='distinct photos users pick uploads from')
+    parser.add_argument('--videos', type=int, default=200, help='distinct YouTube IDs users pick from')
+    parser.add_argument('--api-latency', type=float, default=0, help='simulated Bot API round trip in ms')
+    parser.add_argument('--video-job-seconds', type=float, default=0.5, help='time a simulated video job takes')
+    parser.add_argument('--global-rate', type=float, help='override GLOBAL_MESSAGES_PER_SECOND')
+    parser.add_argument('--chat-rate', type=float, help='override CHAT_MESSAGES_PER_SECOND')
+    parser.add_argument('--stall-ms', type=float, default=50, help='loop lag counted as a stall')
+    parser.add_argument('--timeout', type=float, default=300, help='max seconds to wait for work to drain')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='results file (default benchmarks/results/conversation_load_<time>.json)')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative change counted as a regression')
+    parser.add_argument('--min-delta-ms', type=float, default=1.0,
+                        help='smallest latency increase counted as a regression')
+    parser.add_argument('--verbose', action='store_true', help='keep the bot\'s INFO logging')
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output or os.path.join(
+        REPO_DIR, 'benchmarks', 'results', f"conversation_load_{time.strftime('%Y%m%d_%H%M%S')}.json"
+    ))
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        # Keep the bot's databases, caches and log file out of the working tree
+        os.chdir(workdir)
+        for name, path in (('USER_STORE_PATH', 'user_data.db'), ('UPLOAD_QUEUE_PATH', 'upload_queue.db'),
+                           ('MEDIA_CACHE_DIR', 'downloads'), ('TRANSCODE_DIR', 'transcodes'),
+                           ('REELS_DIR', 'reels'), ('HASHTAG_INDEX_PATH', 'hashtag_index.npz'),
+                           ('ANALYTICS_DIR', 'analytics'), ('PERSISTENCE_PATH', 'conversations.db')):
+            os.environ[name] = os.path.join(workdir, path)
+        if args.global_rate:
+            os.environ['GLOBAL_MESSAGES_PER_SECOND'] = str(args.global_rate)
+        if args.chat_rate:
+            os.environ['CHAT_MESSAGES_PER_SECOND'] = str(args.chat_rate)
+
+        import Instagram_Auto_Adv  # noqa: F401 - configures logging, which is then quietened
+        if not args.verbose:
+            logging.getLogger('TelegramSocialBot').setLevel(logging.WARNING)
+            logging.getLogger('telegram').setLevel(logging.WARNING)
+
+        results = asyncio.run(run_load(args))
+        os.chdir(REPO_DIR)
+
+    results['meta'] = {
+        'revision': git_revision(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(), 'machine': platform.machine(), 'cpus': os.cpu_count(),
+        'args': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+    }
+    print_report(results)
+
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nresults written to {output}")
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance, args.min_delta_ms)
+        if regressions:
+            print(f"\n{len(regressions)} metric(s) regressed by more than {args.tolerance:.0%}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
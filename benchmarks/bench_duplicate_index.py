@@ -0,0 +1,82 @@
+"""Benchmark DuplicateIndex lookups on synthetic perceptual hashes.
+
+Fills one account with random 64-bit hashes, then times lookups for
+near-duplicates (a stored hash with a few bits flipped) and for unrelated
+hashes, and checks that every near-duplicate is found. Snapshot save and
+load times are reported too.
+
+    python benchmarks/bench_duplicate_index.py --sizes 10000 100000 500000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Instagram_Auto_Adv import DuplicateIndex, DUPLICATE_MAX_DISTANCE
+
+
+def flip_bits(rng, value, count):
+    """Flip `count` distinct random bits of a 64-bit value"""
+    for bit in rng.choice(64, count, replace=False):
+        value ^= 1 << int(bit)
+    return value
+
+
+def time_lookups(index, queries):
+    """Return per-lookup latencies in ms and how many lookups found a match"""
+    latencies, found = [], 0
+    for query in queries:
+        started = time.perf_counter()
+        found += index.find('account', [query]) is not None
+        latencies.append((time.perf_counter() - started) * 1000)
+    return np.asarray(latencies), found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 300000],
+                        help='hashes stored for the account')
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--distance', type=int, default=DUPLICATE_MAX_DISTANCE,
+                        help='bits flipped in near-duplicate queries')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1)
+    print(f"{'size':>8} {'add us':>7} {'dup p50':>8} {'dup p99':>8} {'miss p50':>9} {'miss p99':>9} "
+          f"{'recall':>7} {'false':>6} {'save s':>7} {'load s':>7}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            path = os.path.join(tmp, f"index_{size}.npz")
+            index = DuplicateIndex(path=path)
+            hashes = rng.integers(0, 2 ** 64, size, dtype=np.uint64).tolist()
+
+            started = time.perf_counter()
+            for value in hashes:
+                index.add('account', [value])
+            add_us = (time.perf_counter() - started) / size * 1e6
+
+            picks = rng.integers(0, size, args.queries)
+            near = [flip_bits(rng, hashes[i], args.distance) for i in picks]
+            unrelated = rng.integers(0, 2 ** 64, args.queries, dtype=np.uint64).tolist()
+            dup_ms, recalled = time_lookups(index, near)
+            miss_ms, false_hits = time_lookups(index, unrelated)
+
+            started = time.perf_counter()
+            index.save()
+            save_s = time.perf_counter() - started
+            started = time.perf_counter()
+            DuplicateIndex(path=path)
+            load_s = time.perf_counter() - started
+
+            print(f"{size:>8} {add_us:>7.2f} {np.percentile(dup_ms, 50):>8.3f} {np.percentile(dup_ms, 99):>8.3f} "
+                  f"{np.percentile(miss_ms, 50):>9.3f} {np.percentile(miss_ms, 99):>9.3f} "
+                  f"{recalled / args.queries:>7.1%} {false_hits:>6} {save_s:>7.2f} {load_s:>7.2f}")
+
+
+if __name__ == '__main__':
+    main()
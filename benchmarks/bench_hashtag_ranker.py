@@ -0,0 +1,89 @@
+"""Benchmark HashtagRanker.rank on a large synthetic vocabulary.
+
+Seeds every niche with an equal share of the tags and records posts that
+tag them under random keywords, then times rank() three ways: while the
+per-keyword candidates are first being built, once they're all cached, and
+straight after record_result() for the same niche and keywords.
+
+    python benchmarks/bench_hashtag_ranker.py --tags 300000 --keywords 200
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Instagram_Auto_Adv import HashtagRanker
+
+
+def time_ranks(ranker, rng, niches, keywords, calls, per_post):
+    """Return rank() latencies in ms for random niches and keyword sets"""
+    latencies = []
+    for call in range(calls):
+        niche = niches[call % len(niches)]
+        chosen = [keywords[i] for i in rng.integers(0, len(keywords), per_post)]
+        started = time.perf_counter()
+        ranker.rank(niche, chosen)
+        latencies.append((time.perf_counter() - started) * 1000)
+    return np.asarray(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tags', type=int, default=300000)
+    parser.add_argument('--keywords', type=int, default=200, help='distinct keywords posts are tagged with')
+    parser.add_argument('--posts', type=int, default=20000, help='results recorded before timing')
+    parser.add_argument('--keywords-per-post', type=int, default=3)
+    parser.add_argument('--calls', type=int, default=3000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1)
+    with tempfile.TemporaryDirectory() as tmp:
+        ranker = HashtagRanker(path=os.path.join(tmp, 'hashtags.npz'), seed=1)
+    niches = list(ranker.niche_ids)
+    per_niche = args.tags // len(niches)
+    for row, niche in enumerate(niches):
+        ranker.seed(niche, [f"n{row}t{i}" for i in range(per_niche)])
+    keywords = [f"keyword{i}" for i in range(args.keywords)]
+
+    started = time.perf_counter()
+    for post in range(args.posts):
+        row = post % len(niches)
+        tags = [f"n{row}t{i}" for i in rng.integers(0, per_niche, 10)] + \
+               [f"n0t{i}" for i in rng.integers(0, per_niche, 3)]
+        chosen = [keywords[i] for i in rng.integers(0, len(keywords), args.keywords_per_post)]
+        ranker.record_result(niches[row], tags, float(rng.random() * 0.1), chosen)
+    record_us = (time.perf_counter() - started) / args.posts * 1e6
+
+    started = time.perf_counter()
+    ranker.warm()
+    warm_ms = (time.perf_counter() - started) * 1000
+
+    sizes = [len(tags) for tags in ranker.keyword_index.values()]
+    print(f"{len(ranker.tags)} tags, {len(keywords)} keywords of ~{np.mean(sizes):.0f} tags, "
+          f"record_result {record_us:.0f} us, warm() {warm_ms:.0f} ms")
+    print(f"{'phase':<22} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    rows = [
+        ('first keyword lookups', time_ranks(ranker, rng, niches, keywords, args.calls, args.keywords_per_post)),
+        ('cached', time_ranks(ranker, rng, niches, keywords, args.calls, args.keywords_per_post)),
+    ]
+    after_record = []
+    for call in range(args.calls // 10):
+        row = call % len(niches)
+        chosen = [keywords[i] for i in rng.integers(0, len(keywords), args.keywords_per_post)]
+        ranker.record_result(niches[row], [f"n{row}t{i}" for i in rng.integers(0, per_niche, 10)], 0.05, chosen)
+        started = time.perf_counter()
+        ranker.rank(niches[row], chosen)
+        after_record.append((time.perf_counter() - started) * 1000)
+    rows.append(('after record_result', np.asarray(after_record)))
+    for label, latencies in rows:
+        print(f"{label:<22} {np.percentile(latencies, 50):>8.3f} {np.percentile(latencies, 99):>8.3f} "
+              f"{latencies.max():>8.3f}")
+
+
+if __name__ == '__main__':
+    main()
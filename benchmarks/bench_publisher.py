@@ -0,0 +1,256 @@
+"""Benchmark InstagramPublisher against a local stub of the Graph API.
+
+Starts a threaded HTTP server that mimics container creation, resumable
+uploads, status polling and media_publish, then publishes Reels for many
+accounts at once. The server can drop connections part-way through a chunk
+and answer with 503s, so the run shows how much data resumption re-sends,
+how many connections the pools open, and whether every upload arrives intact.
+
+    python benchmarks/bench_publisher.py --accounts 50 --posts 2 --size-mb 20 --drop-rate 0.1
+"""
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Instagram_Auto_Adv import InstagramPublisher
+
+
+class StubGraph:
+    """State shared by the stub server's handler threads"""
+
+    def __init__(self, drop_rate, error_rate, seed):
+        self.drop_rate = drop_rate
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.containers = {}
+        self.uploads = {}
+        self.published = {}
+        self.received = 0
+        self.connections = 0
+        self.drops = 0
+        self.errors = 0
+        self.duplicates = 0
+
+    def roll(self, rate):
+        with self.lock:
+            return self.random.random() < rate
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.stub.lock:
+            self.server.stub.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_form(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return dict(urllib.parse.parse_qsl(self.rfile.read(length).decode()))
+
+    def do_GET(self):
+        stub = self.server.stub
+        url = urllib.parse.urlsplit(self.path)
+        parts = url.path.strip('/').split('/')
+        if parts[0] == 'rupload':
+            with stub.lock:
+                upload = stub.uploads.get(parts[1])
+            if upload is None:
+                return self.reply(404, {'error': 'unknown upload'})
+            return self.reply(200, {'offset': len(upload)})
+
+        with stub.lock:
+            container = stub.containers.get(parts[-1])
+        if container is None:
+            return self.reply(404, {'error': 'unknown container'})
+        if container['published']:
+            status = 'PUBLISHED'
+        elif container['size'] is None or len(stub.uploads[parts[-1]]) == container['size']:
+            status = 'FINISHED'
+        else:
+            status = 'IN_PROGRESS'
+        self.reply(200, {'id': parts[-1], 'status_code': status})
+
+    def do_POST(self):
+        stub = self.server.stub
+        parts = urllib.parse.urlsplit(self.path).path.strip('/').split('/')
+        if parts[0] == 'rupload':
+            return self.upload_chunk(parts[1])
+
+        form = self.read_form()
+        if stub.roll(stub.error_rate):
+            with stub.lock:
+                stub.errors += 1
+            return self.reply(503, {'error': 'try again'})
+
+        container_id = str(next(stub.ids))
+        if parts[-1] == 'media':
+            with stub.lock:
+                stub.containers[container_id] = {'form': form, 'size': None, 'published': False}
+                if form.get('upload_type') == 'resumable':
+                    stub.uploads[container_id] = bytearray()
+            host, port = self.server.server_address
+            return self.reply(200, {'id': container_id, 'uri': f"http://{host}:{port}/rupload/{container_id}"})
+        if parts[-1] == 'media_publish':
+            with stub.lock:
+                container = stub.containers[form['creation_id']]
+                duplicate = container['published']
+                container['published'] = True
+                stub.published[container_id] = form['creation_id']
+                stub.duplicates += duplicate
+            if stub.roll(stub.error_rate):
+                # Published, but the reply never arrives
+                self.close_connection = True
+                return
+            return self.reply(200, {'id': container_id})
+        self.reply(404, {'error': 'unknown endpoint'})
+
+    def upload_chunk(self, container_id):
+        stub = self.server.stub
+        length = int(self.headers['Content-Length'])
+        offset = int(self.headers['offset'])
+        with stub.lock:
+            upload = stub.uploads.get(container_id)
+            if upload is not None:
+                stub.containers[container_id]['size'] = int(self.headers['file_size'])
+        if upload is None or offset > len(upload):
+            self.rfile.read(length)
+            return self.reply(400, {'error': 'bad offset'})
+
+        if stub.roll(stub.drop_rate):
+            # Keep part of the chunk and hang up, like a connection lost mid-request
+            data = self.rfile.read(random.randint(0, length))
+            with stub.lock:
+                del upload[offset:]
+                upload += data
+                stub.received += len(data)
+                stub.drops += 1
+            self.close_connection = True
+            return
+
+        data = self.rfile.read(length)
+        with stub.lock:
+            del upload[offset:]
+            upload += data
+            stub.received += len(data)
+        self.reply(200, {'success': True})
+
+
+def make_videos(directory, count, size, seed):
+    """Write `count` random files of `size` bytes and return (path, sha256) pairs"""
+    rng = random.Random(seed)
+    videos = []
+    for index in range(count):
+        path = os.path.join(directory, f"reel_{index}.mp4")
+        data = rng.randbytes(size)
+        with open(path, 'wb') as f:
+            f.write(data)
+        videos.append((path, hashlib.sha256(data).hexdigest()))
+    return videos
+
+
+async def publish_all(publisher, jobs):
+    """Publish every (account, payload) job concurrently; return per-post latencies and failures"""
+    latencies, failures = [], []
+
+    async def publish(account, payload):
+        started = time.perf_counter()
+        try:
+            await publisher.publish(account, payload)
+            latencies.append(time.perf_counter() - started)
+        except Exception as e:
+            failures.append(f"{account}: {e}")
+
+    await asyncio.gather(*(publish(account, payload) for account, payload in jobs))
+    return latencies, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--accounts', type=int, default=20)
+    parser.add_argument('--posts', type=int, default=2, help='Reels per account')
+    parser.add_argument('--size-mb', type=float, default=10)
+    parser.add_argument('--chunk-mb', type=float, default=2)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--drop-rate', type=float, default=0.05,
+                        help='chance a chunk upload is cut off part-way')
+    parser.add_argument('--error-rate', type=float, default=0.05,
+                        help='chance a Graph API call answers 503')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    stub = StubGraph(args.drop_rate, args.error_rate, args.seed)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    server.stub = stub
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+
+    with tempfile.TemporaryDirectory() as tmp:
+        accounts_path = os.path.join(tmp, 'accounts.json')
+        accounts = [f"account{index}" for index in range(args.accounts)]
+        with open(accounts_path, 'w') as f:
+            json.dump({name: {'user_id': str(index), 'access_token': f"token{index}"}
+                       for index, name in enumerate(accounts)}, f)
+
+        videos = make_videos(tmp, args.accounts * args.posts, int(args.size_mb * 1024 ** 2), args.seed)
+        jobs = [
+            (accounts[index % args.accounts], {'type': 'reel', 'media': [path], 'caption': 'bench', 'hashtags': ''})
+            for index, (path, _) in enumerate(videos)
+        ]
+        publisher = InstagramPublisher(
+            base_url=f"http://{host}:{port}", accounts_path=accounts_path, media_root=tmp,
+            concurrency=args.concurrency, chunk_size=int(args.chunk_mb * 1024 ** 2), backoff=0.01, poll_interval=0.01,
+        )
+
+        started = time.perf_counter()
+        latencies, failures = asyncio.run(publish_all(publisher, jobs))
+        elapsed = time.perf_counter() - started
+        publisher.close()
+
+        total = sum(os.path.getsize(path) for path, _ in videos)
+        checksums = {checksum for _, checksum in videos}
+        intact = sum(hashlib.sha256(upload).hexdigest() in checksums for upload in stub.uploads.values())
+    server.shutdown()
+
+    latencies.sort()
+    print(f"published     {len(latencies)}/{len(jobs)} in {elapsed:.1f}s ({total / elapsed / 1024 ** 2:.0f} MB/s)")
+    if latencies:
+        print(f"latency       p50 {latencies[len(latencies) // 2]:.2f}s  max {latencies[-1]:.2f}s")
+    print(f"intact        {intact}/{len(stub.uploads)} uploads")
+    print(f"re-sent       {stub.received - total} bytes over {stub.drops} dropped chunks "
+          f"({(stub.received - total) / max(total, 1):.2%} of payload)")
+    print(f"503s          {stub.errors}")
+    print(f"media_publish {len(stub.published)} calls, {stub.duplicates} for an already published container")
+    print(f"connections   {stub.connections} for {args.accounts} accounts")
+    for failure in failures[:10]:
+        print(f"failed        {failure}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+import glob
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Instagram_Auto_Adv import DuplicateIndex
+
+
+def test_adds_are_replayed_from_the_log_after_a_crash(tmp_path):
+    path = str(tmp_path / 'dup.npz')
+    index = DuplicateIndex(path)
+    now = time.time()
+    index.add('alice', [0x0F0F0F0F0F0F0F0F], now)
+    index.add('bob', [0x1234567812345678, 0x1234567812345679], now)
+    # No close(): the process dies with only the log on disk, its last line cut short
+    index.log.write('["alice", 2, ')
+    index.log.close()
+
+    restored = DuplicateIndex(path)
+    assert restored.find('alice', [0x0F0F0F0F0F0F0F0E], now) == now
+    assert restored.find('bob', [0x1234567812345678, 0x1234567812345679], now) == now
+    assert restored.find('bob', [0x0F0F0F0F0F0F0F0F], now) is None
+    assert restored.next_item == 2
+    restored.close()
+
+
+def test_close_waits_for_a_running_compaction(tmp_path):
+    for attempt in range(20):
+        path = str(tmp_path / f"dup{attempt}.npz")
+        index = DuplicateIndex(path, compact_every=200)
+        now = time.time()
+        for item in range(2000):
+            index.add(f"account{item % 7}", [item * 0x9E3779B97F4A7C15 % 2 ** 64], now)
+        index.close()
+
+        assert not os.path.exists(f"{index.log_path}.1")
+        assert not glob.glob(str(tmp_path / f"dup{attempt}.npz.*"))
+        restored = DuplicateIndex(path)
+        assert restored.next_item == 2000
+        assert sum(account.size for account in restored.accounts.values()) == 2000
+        assert restored.find('account3', [3 * 0x9E3779B97F4A7C15 % 2 ** 64], now) == now
+        restored.close()